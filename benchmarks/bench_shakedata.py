@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""
+Benchmark of the shakedata.py hot paths over the files stored in data/.
+
+Each stage is timed separately on size buckets of real files and the
+results are written as JSON, so that runs can be compared over time.
+
+Usage:
+    python benchmarks/bench_shakedata.py [--stages diff saveIfChanged ...] [--limit 200] [-o results.json] [--history bench_history.jsonl]
+"""
+import argparse
+import glob
+import io
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import shakedata
+
+# (name, min size included, max size excluded) in bytes
+BUCKETS = (
+    ('small', 0, 16 * 1024),
+    ('medium', 16 * 1024, 64 * 1024),
+    ('large', 64 * 1024, None),
+)
+
+CREATED_RE = re.compile(rb'created="[^"]*"')
+DOWNLOADED_RE = re.compile(rb'downloaded="[^"]*"')
+
+
+def bucket_of(size):
+    for name, low, high in BUCKETS:
+        if size >= low and (high is None or size < high):
+            return name
+
+
+def collect_files(data_dir, pattern, limit):
+    """
+    Return up to limit files per size bucket matching data/<month>/<event>/current/<pattern>.
+    """
+    files = {name: [] for name, _, _ in BUCKETS}
+    for path in sorted(glob.glob(os.path.join(data_dir, '*', '*', 'current', pattern))):
+        bucket = files[bucket_of(os.path.getsize(path))]
+        if len(bucket) < limit:
+            bucket.append(path)
+    return files
+
+
+def run_stage(files, prepare, func, repeat, reset=None, finish=None):
+    """
+    Time func(*prepare(path)) on every file of every bucket.
+
+    Args:
+        reset: optional callable(cases), run (untimed) before each timed run.
+        finish: optional callable(), run (timed) after each timed run.
+
+    Returns:
+        dict: bucket -> files, bytes, seconds, ms_per_file and MB_per_s (best of repeat runs).
+    """
+    results = {}
+    for bucket, paths in files.items():
+        if not paths:
+            continue
+        cases = [prepare(path) for path in paths]
+        size = sum(os.path.getsize(path) for path in paths)
+        best = None
+        for _ in range(repeat):
+            if reset is not None:
+                reset(cases)
+            t0 = time.perf_counter()
+            for case in cases:
+                func(*case)
+            if finish is not None:
+                finish()
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        results[bucket] = {
+            'files': len(paths),
+            'bytes': size,
+            'seconds': best,
+            'ms_per_file': 1000. * best / len(paths),
+            'MB_per_s': size / best / 1e6 if best else None,
+        }
+    return results
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_with_new_created(path):
+    # a fresh download differs from the stored file only by 'created'
+    return CREATED_RE.sub(b'created="0"', read(path), count=1), path
+
+
+def read_with_new_downloaded(path):
+    return DOWNLOADED_RE.sub(b'downloaded="0"', read(path), count=1), path, {'downloaded'}
+
+
+def raw_event(path):
+    """
+    Turn a stored event.xml back into the format returned by the ESM event web service.
+    """
+    root = shakedata.parse_xml(read(path))
+    attrib = root.attrib
+    t = datetime.strptime(attrib.pop('time'), "%Y-%m-%dT%H:%M:%SZ")
+    for k in ('year', 'month', 'day', 'hour', 'minute', 'second'):
+        attrib[k] = str(getattr(t, k))
+    attrib.pop('netid', None)
+    attrib.pop('network', None)
+    return (ET.tostring(root, encoding='UTF-8'),)
+
+
+def event_with_other_id(path):
+    return read(path), 'BENCH_EVENT_ID'
+
+
+def fault_text(path):
+    """
+    Turn a stored rupture.json back into the ESM fault text format (lat lon depth).
+    """
+    with open(path) as f:
+        rupture = json.load(f)
+    lines = ['#' + rupture['metadata'].get('reference', '')]
+    for polygon in rupture['features'][0]['geometry']['coordinates'][0]:
+        for lon, lat, depth in polygon:
+            lines.append(f"{lat} {lon} {depth}")
+        lines.append('>')
+    return '\n'.join(lines).encode(), False
+
+
+def legacy_xmldiff_diff(xmlstring, xml_file):
+    """
+    The diff() implementation based on xmldiff and a temporary file, kept
+    here as the baseline of the in-memory comparator.
+    """
+    from tempfile import NamedTemporaryFile
+    from xmldiff import main
+    f = NamedTemporaryFile(delete=False)
+    f.write(xmlstring)
+    path = f.name
+    f.close()
+    diff = main.diff_files(path, xml_file, {'ratio_mode': 'faster', 'fast_match': True})
+    os.unlink(path)
+
+    if len(diff) == 0:
+        return False
+    if len(diff) == 1 and diff[0].name == 'created':
+        return False
+    return True
+
+
+def bench_args(**kwargs):
+    """
+    The shakedata.args of a run with default options, updated with kwargs.
+    """
+    args = argparse.Namespace(
+        git_repo_dir=REPO_DIR, state_dir=tempfile.gettempdir(), workers=1, commit_mode='file',
+        update_eventid=False, update_locstring=None, get_reported_intensity=False,
+        force_download=False, locstring_engine='remote', locstring_cache_ttl=0, locstring_cache_precision=3,
+    )
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def bench_clean_event_data(opts):
+    files = collect_files(opts.data_dir, 'event.xml', opts.limit)
+    return run_stage(files, raw_event, shakedata.clean_event_data, opts.repeat)
+
+
+def bench_update_event_xml(opts):
+    shakedata.args = bench_args(update_eventid=True)
+    files = collect_files(opts.data_dir, 'event.xml', opts.limit)
+    return run_stage(files, event_with_other_id, shakedata.update_event_xml, opts.repeat)
+
+
+def bench_diff(opts):
+    files = collect_files(opts.data_dir, '*_dat.xml', opts.limit)
+    return run_stage(files, read_with_new_created, shakedata.diff, opts.repeat)
+
+
+def bench_diff_xmldiff(opts):
+    try:
+        import xmldiff  # noqa: F401
+    except ImportError:
+        return {'skipped': 'xmldiff is not installed'}
+    files = collect_files(opts.data_dir, '*_dat.xml', opts.limit)
+    return run_stage(files, read_with_new_created, legacy_xmldiff_diff, opts.repeat)
+
+
+def bench_diff_stationlists(opts):
+    files = collect_files(opts.data_dir, '*_dat.xml', opts.limit)
+    return run_stage(files, read_with_new_created,
+                     lambda data, path: shakedata.diff_stationlists(io.BytesIO(data), path), opts.repeat)
+
+
+def bench_diff_ignoring_attrs(opts):
+    files = collect_files(opts.data_dir, '*_REPORTED-INTENSITY_dat.xml.test', opts.limit)
+    return run_stage(files, read_with_new_downloaded, shakedata.diff_ignoring_attrs, opts.repeat)
+
+
+def bench_text_to_json(opts):
+    files = collect_files(opts.data_dir, 'rupture.json', opts.limit)
+    return run_stage(files, fault_text, shakedata.text_to_json, opts.repeat)
+
+
+def _bench_save(opts, commit_mode):
+    """
+    Time saveIfChanged on updated _dat.xml files in a throwaway git repository.
+    """
+    work_dir = tempfile.mkdtemp(prefix='bench_shakedata_')
+    try:
+        subprocess.check_call(['git', 'init', '-q', work_dir])
+        subprocess.check_call(['git', '-C', work_dir, 'config', 'user.name', shakedata.GIT_USERNAME])
+        subprocess.check_call(['git', '-C', work_dir, 'config', 'user.email', 'bench@localhost'])
+        shakedata.args = bench_args(git_repo_dir=work_dir, state_dir=os.path.join(work_dir, '.git', 'shakedata'), commit_mode=commit_mode)
+        shakedata.git_repo = None
+
+        def prepare(path):
+            # the stored file is the old version, the download has one value changed
+            target = os.path.join(work_dir, os.path.relpath(path, opts.data_dir))
+            data = read(path)
+            return data.replace(b'value="', b'value="1', 1), target, os.path.basename(os.path.dirname(os.path.dirname(target)))
+
+        def reset(cases):
+            for data, target, _ in cases:
+                shakedata.writeFile(data.replace(b'value="1', b'value="', 1), target)
+
+        files = collect_files(opts.data_dir, '*_dat.xml', opts.limit)
+        return run_stage(files, prepare, shakedata.saveIfChanged, opts.repeat, reset=reset, finish=shakedata.flush_commits)
+    finally:
+        shakedata.git_repo = None
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_save_if_changed(opts):
+    return _bench_save(opts, 'file')
+
+
+def bench_save_if_changed_batched(opts):
+    return _bench_save(opts, 'run')
+
+
+STAGES = {
+    'clean_event_data': bench_clean_event_data,
+    'update_event_xml': bench_update_event_xml,
+    'diff': bench_diff,
+    'diff_xmldiff': bench_diff_xmldiff,
+    'diff_stationlists': bench_diff_stationlists,
+    'diff_ignoring_attrs': bench_diff_ignoring_attrs,
+    'text_to_json': bench_text_to_json,
+    'saveIfChanged': bench_save_if_changed,
+    'saveIfChanged_batched': bench_save_if_changed_batched,
+}
+
+
+def git_head():
+    try:
+        return subprocess.check_output(['git', '-C', REPO_DIR, 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the shakedata.py hot paths over the data/ corpus")
+    parser.add_argument("--data-dir", default=os.path.join(REPO_DIR, 'data'), help="directory of the stored events [default is data/ of this repository]")
+    parser.add_argument("--stages", nargs='+', default=list(STAGES), choices=list(STAGES), help="stages to run [default is all]")
+    parser.add_argument("--limit", type=int, default=200, help="maximum number of files per size bucket [default is 200]")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs per stage, the best one is kept [default is 3]")
+    parser.add_argument("-o", "--output", default=None, help="JSON results file [default is stdout]")
+    parser.add_argument("--history", default=None, help="JSON lines file the results are appended to, to track them over time")
+    opts = parser.parse_args()
+
+    shakedata.logger = logging.getLogger('bench_shakedata')
+    shakedata.logger.addHandler(logging.NullHandler())
+    shakedata.logger.propagate = False
+    shakedata.args = bench_args()
+
+    results = {
+        'date': datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'commit': git_head(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'limit': opts.limit,
+        'repeat': opts.repeat,
+        'stages': {},
+    }
+    for stage in opts.stages:
+        shakedata.args = bench_args()
+        results['stages'][stage] = STAGES[stage](opts)
+
+    output = json.dumps(results, indent=2)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if opts.history:
+        with open(opts.history, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+
+
+if __name__ == '__main__':
+    main()
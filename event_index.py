@@ -0,0 +1,343 @@
+"""
+Local SQLite index of the events stored in the data/ directory of a
+shakemap-input-eu repository: one row per event (id, time, coordinates,
+magnitude, locstring) and one row per data file (source, size, sha256).
+
+shakedata.py keeps it up to date while saving files; the index is also
+synced with the git history (files pulled from the remote included), so it
+can be queried from the command line:
+
+    $ python event_index.py -o /opt/shakemap-input-eu -s 2024-01-01 --minmag 5 --source esm
+
+or from Python:
+
+    index = EventIndex(default_index_path(repo_dir))
+    index.sync(repo_dir)
+    for event in index.query(minmag=5, sources=['esm']):
+        ...
+
+Only the standard library is used.
+"""
+import os
+import sys
+import json
+import sqlite3
+import hashlib
+import argparse
+import subprocess
+import xml.etree.ElementTree as ET
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    event_id TEXT PRIMARY KEY,
+    time TEXT,
+    latitude REAL,
+    longitude REAL,
+    depth REAL,
+    magnitude REAL,
+    locstring TEXT
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_magnitude ON events (magnitude);
+CREATE TABLE IF NOT EXISTS files (
+    event_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    source TEXT NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    PRIMARY KEY (event_id, name)
+);
+CREATE INDEX IF NOT EXISTS files_source ON files (source, event_id);
+"""
+
+# source of a data file, from the end of its name (the first match wins)
+FILE_SOURCES = (
+    ('event.xml', 'event'),
+    ('_B_ESM_dat.xml', 'esm'),
+    ('_A_RRSM_dat.xml', 'rrsm'),
+    ('_REPORTED-INTENSITY_dat.xml.test', 'intensity'),
+    ('_FELT-REPORT_dat.xml.test', 'intensity'),
+    ('rupture.json', 'rupture'),
+    ('_dat.xml', 'macroseismic'),
+)
+SOURCES = sorted(set(source for _, source in FILE_SOURCES)) + ['other']
+
+def default_state_dir(repo_dir):
+    """
+    Default shakedata.py state directory (--state-dir) of repo_dir: shakedata
+    in its git directory, as resolved by git (worktrees and submodules included).
+    """
+    return os.path.join(repo_dir, git_output(repo_dir, "rev-parse", "--git-path", "shakedata").strip())
+
+def default_index_path(repo_dir, state_dir=None):
+    """
+    Path of the index in the shakedata.py state directory of repo_dir.
+    """
+    return os.path.join(state_dir or default_state_dir(repo_dir), 'event_index.sqlite')
+
+def file_source(name):
+    for suffix, source in FILE_SOURCES:
+        if name.endswith(suffix):
+            return source
+    return 'other'
+
+def split_data_path(path):
+    """
+    Split a data/YYYYMM/<event_id>/current/<name> path, relative to the repository.
+
+    Returns:
+        (event_id, name), or None for a path outside the layout of the events.
+    """
+    parts = os.path.normpath(path).split(os.sep)
+    if len(parts) != 5 or parts[0] != 'data' or parts[3] != 'current':
+        return None
+    return parts[2], parts[4]
+
+def parse_event_xml(data):
+    """
+    Read the event fields from the content of an event.xml.
+
+    Returns:
+        dict with time, latitude, longitude, depth, magnitude and locstring;
+        empty when the file cannot be parsed.
+    """
+    def to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    try:
+        # the files declare encoding='utf8', which expat does not know
+        attrib = ET.fromstring(data, parser=ET.XMLParser(encoding='utf-8')).attrib
+    except ET.ParseError:
+        return {}
+    time = attrib.get('time')
+    return {
+        # without the trailing Z, so that times compare as strings with the query bounds
+        'time': time.rstrip('Z') if time else None,
+        'latitude': to_float(attrib.get('lat')),
+        'longitude': to_float(attrib.get('lon')),
+        'depth': to_float(attrib.get('depth')),
+        'magnitude': to_float(attrib.get('mag')),
+        'locstring': attrib.get('locstring'),
+    }
+
+def git_output(repo_dir, *args):
+    return subprocess.check_output(["git", "-C", repo_dir, "-c", "core.quotepath=off"] + list(args), stderr=subprocess.DEVNULL).decode('utf-8')
+
+class EventIndex:
+    """
+    SQLite index of the events of a repository.
+
+    Changes are written in a transaction, made durable by commit().
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row is not None else None
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def update_file(self, repo_dir, path, data=None):
+        """
+        Index a data file of the repository, or remove it from the index if it
+        no longer exists; paths outside data/YYYYMM/<event_id>/current are ignored.
+
+        Args:
+            repo_dir (str): The repository directory.
+            path (str): Path of the file, absolute or relative to repo_dir.
+            data (bytes): Content of the file, if already in memory.
+        """
+        relative_path = os.path.relpath(os.path.join(repo_dir, path), repo_dir)
+        split = split_data_path(relative_path)
+        if split is None:
+            return
+        event_id, name = split
+        if data is None:
+            try:
+                with open(os.path.join(repo_dir, relative_path), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                self.remove_file(event_id, name)
+                return
+
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files (event_id, name, source, size, sha256) VALUES (?, ?, ?, ?, ?)",
+            (event_id, name, file_source(name), len(data), hashlib.sha256(data).hexdigest())
+        )
+        fields = parse_event_xml(data) if name == 'event.xml' else {}
+        self.conn.execute("INSERT OR IGNORE INTO events (event_id) VALUES (?)", (event_id,))
+        if fields:
+            self.conn.execute(
+                "UPDATE events SET time = ?, latitude = ?, longitude = ?, depth = ?, magnitude = ?, locstring = ? WHERE event_id = ?",
+                (fields['time'], fields['latitude'], fields['longitude'], fields['depth'], fields['magnitude'], fields['locstring'], event_id)
+            )
+
+    def remove_file(self, event_id, name):
+        self.conn.execute("DELETE FROM files WHERE event_id = ? AND name = ?", (event_id, name))
+        if self.conn.execute("SELECT 1 FROM files WHERE event_id = ? LIMIT 1", (event_id,)).fetchone() is None:
+            self.conn.execute("DELETE FROM events WHERE event_id = ?", (event_id,))
+
+    def rebuild(self, repo_dir):
+        """
+        Index again every file in the data/ directory of repo_dir.
+        """
+        self.conn.execute("DELETE FROM files")
+        self.conn.execute("DELETE FROM events")
+        data_dir = os.path.join(repo_dir, 'data')
+        for month in sorted(os.listdir(data_dir)) if os.path.isdir(data_dir) else []:
+            month_dir = os.path.join(data_dir, month)
+            if not os.path.isdir(month_dir):
+                continue
+            for event_id in sorted(os.listdir(month_dir)):
+                current_dir = os.path.join(month_dir, event_id, 'current')
+                if not os.path.isdir(current_dir):
+                    continue
+                for name in sorted(os.listdir(current_dir)):
+                    self.update_file(repo_dir, os.path.join('data', month, event_id, 'current', name))
+
+    def sync(self, repo_dir):
+        """
+        Bring the index up to date with the HEAD of repo_dir: only the data/
+        files changed by the commits since the last sync are indexed again;
+        the first time, or when that commit is no longer an ancestor of HEAD,
+        the index is rebuilt.
+
+        Returns:
+            int: number of files indexed again, or None when the index was rebuilt.
+        """
+        head = git_output(repo_dir, "rev-parse", "HEAD").strip()
+        indexed_head = self.get_meta('head')
+        if indexed_head == head:
+            return 0
+        changed = None
+        if indexed_head is not None:
+            try:
+                git_output(repo_dir, "merge-base", "--is-ancestor", indexed_head, head)
+                changed = git_output(repo_dir, "diff", "--no-renames", "--name-only", indexed_head, head, "--", "data").splitlines()
+            except subprocess.CalledProcessError:
+                changed = None
+        if changed is None:
+            self.rebuild(repo_dir)
+        else:
+            for path in changed:
+                self.update_file(repo_dir, path)
+        self.set_meta('head', head)
+        self.commit()
+        return None if changed is None else len(changed)
+
+    def has_event(self, event_id):
+        return self.conn.execute("SELECT 1 FROM events WHERE event_id = ?", (event_id,)).fetchone() is not None
+
+    def query(self, starttime=None, endtime=None, minlat=None, maxlat=None, minlon=None, maxlon=None, minmag=None, maxmag=None, sources=(), event_ids=None):
+        """
+        Find the indexed events matching all the given filters.
+
+        Args:
+            starttime, endtime (str): ISO times (e.g. 2024-01-01 or 2024-01-01T12:00:00), included.
+            minlat, maxlat, minlon, maxlon, minmag, maxmag (float): bounds, included.
+            sources (list): sources (see SOURCES) every event must have.
+            event_ids (list): restrict the search to these IDs.
+
+        Returns:
+            list of dict: the event fields, with 'files' (name -> sha256) and
+            'sources', the latest event first.
+        """
+        where = []
+        params = []
+        for column, op, value in (
+                ('time', '>=', starttime), ('time', '<=', endtime),
+                ('latitude', '>=', minlat), ('latitude', '<=', maxlat),
+                ('longitude', '>=', minlon), ('longitude', '<=', maxlon),
+                ('magnitude', '>=', minmag), ('magnitude', '<=', maxmag)):
+            if value is not None:
+                where.append(f"e.{column} {op} ?")
+                params.append(value)
+        for source in sources:
+            where.append("EXISTS (SELECT 1 FROM files f WHERE f.event_id = e.event_id AND f.source = ?)")
+            params.append(source)
+        if event_ids is not None:
+            where.append(f"e.event_id IN ({','.join('?' * len(event_ids))})")
+            params.extend(event_ids)
+        sql = "SELECT e.* FROM events e"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY e.time DESC, e.event_id DESC"
+
+        events = []
+        for row in self.conn.execute(sql, params):
+            event = dict(row)
+            files = self.conn.execute("SELECT name, source, sha256 FROM files WHERE event_id = ? ORDER BY name", (event['event_id'],)).fetchall()
+            event['files'] = {f['name']: f['sha256'] for f in files}
+            event['sources'] = sorted(set(f['source'] for f in files))
+            events.append(event)
+        return events
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Query the local index of the events stored in a shakemap-input-eu repository.")
+    parser.add_argument("-o", "--output", dest="git_repo_dir", required=True, help="provide the repository directory (e.g., /opt/shakemap-input-eu)")
+    parser.add_argument("--state-dir", default=None, help="state directory of shakedata.py, as given to its --state-dir [default is <output>/.git/shakedata]")
+    parser.add_argument("--index", default=None, help="path of the SQLite index [default is <state-dir>/event_index.sqlite]")
+    parser.add_argument("--rebuild", action='store_true', default=False, help="index again every file in data/")
+    parser.add_argument("--no-sync", action='store_true', default=False, help="query the index as it is, without syncing it with the git HEAD first")
+    parser.add_argument("-k", "--keep", default=None, help="comma-separated list of event IDs")
+    parser.add_argument("-s", "--starttime", default=None, help="events after this time (e.g., 2020-10-23T00:00:00)")
+    parser.add_argument("-e", "--endtime", default=None, help="events before this time (e.g., 2020-10-23T23:59:59)")
+    parser.add_argument("--minlat", type=float, default=None)
+    parser.add_argument("--maxlat", type=float, default=None)
+    parser.add_argument("--minlon", type=float, default=None)
+    parser.add_argument("--maxlon", type=float, default=None)
+    parser.add_argument("-m", "--minmag", type=float, default=None)
+    parser.add_argument("--maxmag", type=float, default=None)
+    parser.add_argument("--source", action='append', default=[], choices=SOURCES, help="events having data from this source; can be repeated")
+    parser.add_argument("--json", action='store_true', default=False, help="print the events as JSON lines, with their files and hashes")
+    args = parser.parse_args()
+
+    try:
+        index = EventIndex(args.index or default_index_path(args.git_repo_dir, args.state_dir))
+    except (sqlite3.Error, subprocess.CalledProcessError) as e:
+        sys.exit(f"event index: {str(e)}")
+    try:
+        if args.rebuild:
+            index.rebuild(args.git_repo_dir)
+            index.set_meta('head', git_output(args.git_repo_dir, "rev-parse", "HEAD").strip())
+            index.commit()
+        elif not args.no_sync:
+            index.sync(args.git_repo_dir)
+        events = index.query(
+            starttime=args.starttime, endtime=args.endtime,
+            minlat=args.minlat, maxlat=args.maxlat, minlon=args.minlon, maxlon=args.maxlon,
+            minmag=args.minmag, maxmag=args.maxmag, sources=args.source,
+            event_ids=[eid.strip() for eid in args.keep.split(',')] if args.keep else None
+        )
+    except (sqlite3.Error, subprocess.CalledProcessError) as e:
+        sys.exit(f"event index {index.path}: {str(e)}")
+    finally:
+        index.close()
+
+    for event in events:
+        if args.json:
+            print(json.dumps(event))
+        else:
+            print(f"{event['event_id']}  {event['time']}  {event['latitude']} {event['longitude']}  {event['magnitude']}  {','.join(event['sources'])}  {event['locstring'] or ''}")
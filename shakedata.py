@@ -1,11 +1,17 @@
 import os.path
 import subprocess
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import random
+import threading
+import time
+import hashlib
+import re
+from collections import namedtuple
 import json
 import xml.etree.ElementTree as ET
-from obspy import UTCDateTime, Catalog
-from obspy.clients.fdsn.header import URL_MAPPINGS
-from obspy.clients.fdsn import Client
+from event_index import EventIndex, default_state_dir
 import git
 from pathlib import Path
 import logging
@@ -13,11 +19,18 @@ import argparse
 import sys
 import inspect
 import functools
-from xmldiff import main
-from xmldiff import actions as xmldiff_actions
-from  tempfile import NamedTemporaryFile
+import contextlib
+import signal
+import cProfile
+import pstats
+from urllib.parse import urlsplit, urlencode
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+import itertools
+import io
+import tempfile
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 
 # test
@@ -26,18 +39,132 @@ from datetime import datetime
 #USRNAME = "&username=spada"
 ONEDAY = 3600 * 24
 fdsn_client = 'EMSC'
+# FDSN event services queried by --event-source text (obspy is not used there)
+FDSN_EVENT_URLS = {
+    'EMSC': "https://www.seismicportal.eu/fdsnws/event/1/query",
+}
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# the time window of find_events is queried in slices of at most EVENT_QUERY_SLICE;
+# a slice returning EVENT_QUERY_LIMIT events is split in two, down to EVENT_QUERY_MIN_SLICE
+EVENT_QUERY_LIMIT = 1000
+EVENT_QUERY_SLICE = timedelta(days=30)
+EVENT_QUERY_MIN_SLICE = timedelta(minutes=1)
 GIT_USERNAME = 'sergio'
 TAB_SIZE = 2
 INGV_BOUNDARIES_BASE_URL = "https://webservices.ingv.it/ingvws/boundaries"
+ESM_EVENT_UPDATE_URL = "https://esm-db.eu/esmws/event-processing-update/1/query"
+# XML attributes regenerated on every request, ignored when comparing files
+VOLATILE_XML_ATTRS = frozenset(['created'])
+# volatile attributes stripped before fingerprinting a download (see StreamingFingerprint)
+VOLATILE_ATTRS_RE = re.compile(rb'\s(?:created|downloaded)="[^"]*"')
+# downloads are read in chunks of this size, and kept in memory up to
+# DOWNLOAD_SPOOL_SIZE bytes before being spooled to a temporary file
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_SPOOL_SIZE = 1024 * 1024
 # global logger
 logger = None
 
-# repository files
-# this dictionary contains, for each file in the git repository
-# the author and date of last modification
-repository_files = {}
+# shared HTTP session (see get_http_session)
+http_session = None
+http_session_lock = threading.Lock()
+# HTTP status codes considered transient and retried
+HTTP_RETRY_STATUS = (500, 502, 503, 504)
+# rate limit, concurrency cap and circuit breaker of each upstream host (see get_host_policy)
+host_policies = {}
+host_policies_lock = threading.Lock()
+
+# cached git.Repo handle (see get_git_repo)
+git_repo = None
+# data/YYYYMM months checked out with --sparse-checkout (see set_sparse_checkout)
+sparse_checkout_months = None
+# files saved but not yet committed, when commits are batched (see commit_file)
+pending_commits = []
 
-URL_MAPPINGS["EMSC"] = "https://www.seismicportal.eu"
+# repository files
+# this dictionary contains, for each file in the git repository,
+# the author of the last modification (see get_repository_files_info);
+# None until the index has been loaded
+repository_files = None
+# state file of the last-author index, relative to args.state_dir
+# (v2: merge commits are attributed, see get_git_log_authors)
+REPOSITORY_FILES_STATE = 'last_authors.v2.json'
+
+# download manifest: for each output file, the URL, ETag, Last-Modified and
+# content fingerprint of its last download (see DownloadIfChanged)
+manifest = None
+manifest_lock = threading.Lock()
+MANIFEST_STATE = 'manifest.json'
+
+# cache of get_locstring results, keyed by mode and rounded coordinates
+locstring_cache = None
+locstring_cache_lock = threading.Lock()
+LOCSTRING_CACHE_STATE = 'locstring_cache.json'
+
+# EventRecord fields of the -k/--keep event IDs already looked up (see resolve_event_ids)
+resolved_events = None
+resolved_events_lock = threading.Lock()
+RESOLVED_EVENTS_STATE = 'resolved_events.json'
+# days an event is taken from the cache before being looked up again: its origin may be revised
+RESOLVED_EVENTS_TTL = 1
+
+# "no data" answers of the upstream sources, by event and source (see DownloadUnlessNoData)
+negative_cache = None
+negative_cache_lock = threading.Lock()
+NEGATIVE_CACHE_STATE = 'negative_cache.json'
+# HTTP status codes meaning that a source has no data (yet) for an event
+NEGATIVE_CACHE_STATUS = (204, 404)
+# catalog origin of the events of the current cycle (see invalidate_negative_cache)
+negative_cache_origins = {}
+
+# in a --backfill worker process, the cache entries changed while fetching an
+# event, sent back to the parent with its files (see fetch_backfill_event)
+cache_journal = None
+
+# next refresh of each event, with --adaptive-refresh (see due_events)
+refresh_schedule = None
+REFRESH_SCHEDULE_STATE = 'refresh_schedule.json'
+# an event is refreshed again after this fraction of the time elapsed since
+# its origin, or since its data last changed
+REFRESH_DECAY = 0.1
+# days an event not refreshed any more is kept in the schedule
+REFRESH_SCHEDULE_KEEP = 30
+
+# SQLite index of the events in data/ (see sync_event_index and event_index.py)
+event_index = None
+EVENT_INDEX_STATE = 'event_index.sqlite'
+
+# columnar store of the station amplitudes, with --station-store (see station_store.py)
+station_store = None
+STATION_STORE_STATE = 'station_store'
+
+# offline Flinn-Engdahl regionalization (see get_flinn_engdahl_grid)
+flinn_engdahl_grid = None
+flinn_engdahl_grid_lock = threading.Lock()
+# v2: the regions the INGV boundary service did not label are left unlabelled
+FLINN_ENGDAHL_GRID_STATE = 'flinn_engdahl_grid.v2.npz'
+
+# watermark of the ESM event-processing-update query (see find_updated_events)
+ESM_UPDATES_STATE = 'esm_updated_after.json'
+# seconds the next ESM updates window overlaps the current one
+ESM_UPDATES_OVERLAP = 60
+
+# months already processed by --backfill (see run_backfill)
+BACKFILL_STATE = 'backfill.json'
+
+# hash and problems of each file checked by --scan-integrity (see scan_integrity)
+INTEGRITY_SCAN_STATE = 'integrity_scan.json'
+INTEGRITY_REPORT = 'integrity_report.json'
+# attributes every event.xml must have
+REQUIRED_EVENT_ATTRS = ('id', 'netid', 'network', 'lat', 'lon', 'depth', 'mag', 'time', 'locstring')
+
+# result of DownloadIfChanged: HTTP status (None on connection errors), the
+# data to be saved (None when failed or unchanged), the new manifest entry
+# and, for XML files, the XmlFingerprint of the data
+Download = namedtuple('Download', ['status', 'data', 'entry', 'fingerprint'], defaults=[None])
+
+# the fields of an event used by shakedata, whatever the --event-source;
+# time is a naive UTC datetime, depth is in km, missing values are None
+EventRecord = namedtuple('EventRecord', ['event_id', 'time', 'latitude', 'longitude', 'depth', 'magnitude', 'magnitude_type'])
 
 class ShakeLibException(Exception):
     """
@@ -151,6 +278,199 @@ def catch_all_and_print(f):
             sys.exit()
     return inner
 
+class RunMetrics:
+    """
+    Wall time, call count and bytes of each stage of a run, and of the
+    requests made to each upstream host.
+
+    Stage times are inclusive (a stage running inside another one is counted
+    in both) and, with --workers, summed over the worker threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.stages = {}
+        self.hosts = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, nbytes=0):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - t0, nbytes)
+
+    def add_stage(self, name, seconds, nbytes=0):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'seconds': 0., 'calls': 0, 'bytes': 0})
+            stage['seconds'] += seconds
+            stage['calls'] += 1
+            stage['bytes'] += nbytes
+
+    def add_request(self, host, seconds, nbytes, status):
+        """
+        Record a request to host; status is None when the request failed without an answer.
+        """
+        with self.lock:
+            stats = self.host_stats(host)
+            stats['seconds'] += seconds
+            stats['requests'] += 1
+            stats['bytes'] += nbytes
+            if status is None:
+                stats['errors'] += 1
+            else:
+                stats['status'][str(status)] = stats['status'].get(str(status), 0) + 1
+
+    def add_bytes(self, host, nbytes):
+        """
+        Record the bytes of the body of a response to host.
+        """
+        with self.lock:
+            self.host_stats(host)['bytes'] += nbytes
+
+    def host_stats(self, host):
+        return self.hosts.setdefault(host, {'seconds': 0., 'requests': 0, 'bytes': 0, 'errors': 0, 'status': {}})
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, summary):
+        """
+        Add the stages, requests and counters of another summary (e.g. of a
+        --backfill worker process) to these metrics.
+        """
+        with self.lock:
+            for name, stage in summary['stages'].items():
+                total = self.stages.setdefault(name, {'seconds': 0., 'calls': 0, 'bytes': 0})
+                for key in total:
+                    total[key] += stage[key]
+            for host, stats in summary['hosts'].items():
+                total = self.host_stats(host)
+                for key in ('seconds', 'requests', 'bytes', 'errors'):
+                    total[key] += stats[key]
+                for code, n in stats['status'].items():
+                    total['status'][code] = total['status'].get(code, 0) + n
+            for name, value in summary['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self.lock:
+            return {
+                'start_time': self.start_time,
+                'duration_seconds': time.time() - self.start_time,
+                'stages': json.loads(json.dumps(self.stages)),
+                'hosts': json.loads(json.dumps(self.hosts)),
+                'counters': dict(self.counters),
+            }
+
+    def prometheus(self, prefix='shakedata'):
+        """
+        Return the summary in the Prometheus text exposition format.
+        """
+        summary = self.summary()
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+
+        stages = sorted(summary['stages'].items())
+        hosts = sorted(summary['hosts'].items())
+        metric('run_start_timestamp_seconds', 'Start time of the last run.', [((), summary['start_time'])])
+        metric('run_duration_seconds', 'Wall time of the last run.', [((), summary['duration_seconds'])])
+        metric('stage_seconds', 'Wall time spent in each stage during the last run.', [((('stage', k),), v['seconds']) for k, v in stages])
+        metric('stage_calls', 'Calls of each stage during the last run.', [((('stage', k),), v['calls']) for k, v in stages])
+        metric('stage_bytes', 'Bytes processed by each stage during the last run.', [((('stage', k),), v['bytes']) for k, v in stages])
+        metric('http_seconds', 'Wall time spent in requests to each host during the last run.', [((('host', k),), v['seconds']) for k, v in hosts])
+        metric('http_requests', 'Requests to each host during the last run.', [((('host', k),), v['requests']) for k, v in hosts])
+        metric('http_bytes', 'Bytes downloaded from each host during the last run.', [((('host', k),), v['bytes']) for k, v in hosts])
+        metric('http_errors', 'Requests to each host failed without an answer during the last run.', [((('host', k),), v['errors']) for k, v in hosts])
+        metric('http_responses', 'Responses of each host by status code during the last run.',
+               [((('host', k), ('code', code)), n) for k, v in hosts for code, n in sorted(v['status'].items())])
+        metric('run_count', 'Counters of the last run.', [((('name', k),), v) for k, v in sorted(summary['counters'].items())])
+        return '\n'.join(lines) + '\n'
+
+# metrics of the run
+metrics = RunMetrics()
+
+# set by SIGTERM/SIGINT in --daemon mode: finish the current event, then stop
+stop_requested = threading.Event()
+
+def timed(name, nbytes=None):
+    """
+    A function wrapper recording the wall time, calls and bytes of a stage in metrics.
+
+    Args:
+        name (str): The stage.
+        nbytes: function of the result and of the arguments of a call,
+            returning the bytes it processed.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def inner(*args, **kwargs):
+            t0 = time.perf_counter()
+            size = 0
+            try:
+                result = f(*args, **kwargs)
+                if nbytes is not None:
+                    size = nbytes(result, *args, **kwargs)
+                return result
+            finally:
+                metrics.add_stage(name, time.perf_counter() - t0, size)
+        return inner
+    return decorator
+
+def data_size(data):
+    """
+    Size of the data processed by a stage: bytes, a string, a BytesIO or a file path.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    if isinstance(data, io.BytesIO):
+        return data.getbuffer().nbytes
+    if isinstance(data, str):
+        return os.path.getsize(data) if os.path.isfile(data) else len(data.encode())
+    return 0
+
+def fetched_size(fetched):
+    """
+    Bytes of the files of an event to be saved (see fetch_event_xml_data).
+    """
+    return sum(len(data) for data, _, _, _ in fetched if data is not None)
+
+def write_text_atomically(path, text):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def write_metrics():
+    """
+    Write the metrics of the run to --metrics-json and --metrics-prom, if set.
+    """
+    if args.metrics_json:
+        write_text_atomically(args.metrics_json, json.dumps(metrics.summary(), indent=2) + '\n')
+        logger.info(f"Metrics written to {args.metrics_json}")
+    if args.metrics_prom:
+        write_text_atomically(args.metrics_prom, metrics.prometheus())
+        logger.info(f"Metrics written to {args.metrics_prom}")
+
+def write_profile(profiler):
+    """
+    Dump the cProfile statistics of the run to --profile, and a text report to --profile + '.txt'.
+    """
+    profiler.dump_stats(args.profile)
+    with open(args.profile + '.txt', 'w') as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats('cumulative').print_stats(50)
+    logger.info(f"Profile written to {args.profile} and {args.profile}.txt")
+
 def create_logger(severity):
     log_name = Path(__file__).stem
     _logger = logging.getLogger(log_name)
@@ -207,36 +527,152 @@ def set_args():
     # time to verify backward if input files from ESM have changed
     #args.chkbcktime = float(args.chkbcktime) * ONEDAY # in seconnds
 
+    set_time_window()
+
+    if args.backfill and (keep_provided or args.daemon or args.esm_updates is not None or args.relabel_locstrings or args.build_flinn_engdahl_grid):
+        sys.exit("Error: Cannot use --backfill together with -k/--keep, --daemon, --esm-updates, --relabel-locstrings or --build-flinn-engdahl-grid.")
+
+    if args.scan_integrity and (keep_provided or args.daemon or args.backfill or args.relabel_locstrings or args.build_flinn_engdahl_grid):
+        sys.exit("Error: Cannot use --scan-integrity together with -k/--keep, --daemon, --backfill, --relabel-locstrings or --build-flinn-engdahl-grid.")
+
+    if args.sparse_checkout and (args.relabel_locstrings or args.scan_integrity):
+        sys.exit("Error: Cannot use --sparse-checkout together with --relabel-locstrings or --scan-integrity: they need every file of data/.")
+
+    if args.scan_processes is None:
+        args.scan_processes = os.cpu_count() or 1
+    if args.scan_processes < 1:
+        sys.exit(f"option --scan-processes must be a positive integer: {args.scan_processes}")
+
+    if args.backfill_processes is None:
+        args.backfill_processes = os.cpu_count() or 1
+    if args.backfill_processes < 1:
+        sys.exit(f"option --backfill-processes must be a positive integer: {args.backfill_processes}")
+
+    if args.esm_updates is not None and keep_provided:
+        sys.exit("Error: Cannot use --esm-updates together with -k/--keep.")
+
+    if args.esm_updates == 'only' and (starttime_provided or endtime_provided):
+        sys.exit("Error: Cannot use --esm-updates only together with -s/--starttime or -e/--endtime: only the events updated by ESM are processed.")
+
+    if args.esm_updated_after is not None:
+        if args.esm_updates is None:
+            sys.exit("Error: --esm-updated-after requires --esm-updates.")
+        try:
+            parse_time(args.esm_updated_after)
+        except ValueError as e:
+            sys.exit(f"option --esm-updated-after is not valid time {args.esm_updated_after}. {str(e)}")
+
+    if args.daemon and (keep_provided or starttime_provided or endtime_provided):
+        sys.exit("Error: Cannot use --daemon together with -k/--keep, -s/--starttime or -e/--endtime: each cycle processes the -d/--days_ago window ending at the cycle time.")
+
+    if args.daemon and (args.relabel_locstrings or args.build_flinn_engdahl_grid):
+        sys.exit("Error: Cannot use --daemon together with --relabel-locstrings or --build-flinn-engdahl-grid.")
+
+    if args.poll_interval <= 0:
+        sys.exit(f"option --poll-interval must be positive: {args.poll_interval}")
+
+    if args.workers < 1:
+        sys.exit(f"option --workers must be a positive integer: {args.workers}")
+
+    if args.query_workers < 1:
+        sys.exit(f"option --query-workers must be a positive integer: {args.query_workers}")
+
+    if args.locstring_engine == 'offline' and args.update_locstring == 'region_name':
+        sys.exit("Error: --locstring-engine offline is only available with -r/--update-locstring boundary.")
+
+    if args.adaptive_refresh and args.backfill:
+        sys.exit("Error: Cannot use --adaptive-refresh together with --backfill: a backfill processes every event of the window.")
+
+    if args.refresh_min_interval < 0 or args.refresh_max_interval < args.refresh_min_interval:
+        sys.exit(f"options --refresh-min-interval and --refresh-max-interval must satisfy 0 <= min <= max: {args.refresh_min_interval}, {args.refresh_max_interval}")
+
+    if args.negative_cache_ttl < 0 or args.negative_cache_max_ttl < args.negative_cache_ttl:
+        sys.exit(f"options --negative-cache-ttl and --negative-cache-max-ttl must satisfy 0 <= ttl <= max ttl: {args.negative_cache_ttl}, {args.negative_cache_max_ttl}")
+
+    if args.host_rate < 0 or args.host_max_in_flight < 1 or args.breaker_failures < 1 or args.breaker_cooldown < 0:
+        sys.exit(f"options --host-rate, --host-max-in-flight, --breaker-failures and --breaker-cooldown must be positive: {args.host_rate}, {args.host_max_in_flight}, {args.breaker_failures}, {args.breaker_cooldown}")
+
+    if args.max_download_size <= 0:
+        sys.exit(f"option --max-download-size must be positive: {args.max_download_size}")
+
+    if args.connect_timeout <= 0 or args.read_timeout <= 0:
+        sys.exit(f"options --connect-timeout and --read-timeout must be positive: {args.connect_timeout}, {args.read_timeout}")
+
+    if not os.path.isdir(args.git_repo_dir):
+        sys.exit(f"Directory: {args.git_repo_dir} does not exist!!!")
+
+    # caches and indexes are kept out of the working tree, in the git
+    # directory (as event_index.py and station_store.py find it)
+    if args.state_dir is None:
+        try:
+            args.state_dir = default_state_dir(args.git_repo_dir)
+        except subprocess.CalledProcessError:
+            args.state_dir = os.path.join(args.git_repo_dir, '.git', 'shakedata')
+
+def utcnow():
+    """
+    Current UTC time, as a naive datetime.
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def parse_time(string):
+    """
+    Parse an ISO 8601 time (e.g. 2020-10-23, 2020-10-23T00:00:00, 2020-10-23T00:00:00.5Z).
+
+    Returns:
+        naive datetime in UTC. ValueError is raised when string is not a valid time.
+    """
+    string = string.strip()
+    if string.endswith('Z'):
+        string = string[:-1] + '+00:00'
+    # fromisoformat only accepts 3 or 6 decimals for the seconds
+    string = re.sub(r'\.(\d+)', lambda m: '.' + (m.group(1) + '00000')[:6], string, count=1)
+    try:
+        t = datetime.fromisoformat(string)
+    except ValueError:
+        t = datetime.strptime(string, '%Y%m%d')
+    if t.tzinfo is not None:
+        t = t.astimezone(timezone.utc).replace(tzinfo=None)
+    return t
+
+def set_time_window():
+    """
+    Set args.start_time and args.end_time from -d or -s/-e; with -d the
+    window ends now, so it is computed again at each --daemon cycle.
+    """
+    starttime_provided = args.starttime is not None
+    endtime_provided = args.endtime is not None
+
     # Get current time for defaults
-    now = UTCDateTime()
-    today = UTCDateTime(now.strftime("%Y-%m-%d"))
+    now = utcnow()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
 
     # Handle time calculation based on which parameters were provided
     if starttime_provided or endtime_provided:
         # Use explicit start/end times
         if args.starttime is not None:
             try:
-                args.start_time = UTCDateTime(args.starttime).strftime("%Y-%m-%dT%H:%M:%S")
+                args.start_time = parse_time(args.starttime).strftime(TIME_FORMAT)
             except Exception as e:
                 sys.exit(f"option --starttime is not valid time {args.starttime}. {str(e)}")
         else:
             # If only endtime provided, calculate starttime using default 1d
             days_value = 1.0
             try:
-                end_time_obj = UTCDateTime(args.endtime)
-                appo = end_time_obj - days_value * ONEDAY
-                args.start_time = appo.strftime("%Y-%m-%dT%H:%M:%S")
+                end_time_obj = parse_time(args.endtime)
+                appo = end_time_obj - timedelta(seconds=days_value * ONEDAY)
+                args.start_time = appo.strftime(TIME_FORMAT)
             except Exception as e:
                 sys.exit(f"option --endtime is not valid time {args.endtime}. {str(e)}")
 
         if args.endtime is not None:
             try:
-                args.end_time = UTCDateTime(args.endtime).strftime("%Y-%m-%dT%H:%M:%S")
+                args.end_time = parse_time(args.endtime).strftime(TIME_FORMAT)
             except Exception as e:
                 sys.exit(f"option --endtime is not valid time {args.endtime}. {str(e)}")
         else:
             # Default endtime to now
-            args.end_time = now.strftime("%Y-%m-%dT%H:%M:%S")
+            args.end_time = now.strftime(TIME_FORMAT)
 
         # Set days for backward compatibility (use 1d as default)
         args.days = 1.0
@@ -254,47 +690,786 @@ def set_args():
         # If using default 1d (and no explicit times), set to today 00:00:00 - 23:59:59
         if args.days_ago == '1d' and not endtime_provided:
             args.start_time = today.strftime("%Y-%m-%dT00:00:00")
-            args.end_time = (today + ONEDAY - 1).strftime("%Y-%m-%dT23:59:59")
+            args.end_time = today.strftime("%Y-%m-%dT23:59:59")
         else:
             # Calculate based on days_ago from now
-            args.end_time = now.strftime("%Y-%m-%dT%H:%M:%S")
-            appo = now - days_value * ONEDAY
-            args.start_time = appo.strftime("%Y-%m-%dT%H:%M:%S")
+            args.end_time = now.strftime(TIME_FORMAT)
+            appo = now - timedelta(seconds=days_value * ONEDAY)
+            args.start_time = appo.strftime(TIME_FORMAT)
 
         # Store days_value for backward compatibility
         args.days = days_value
 
-    if not os.path.isdir(args.git_repo_dir):
-        sys.exit(f"Directory: {args.git_repo_dir} does not exist!!!")
+class JitteredRetry(Retry):
+    """
+    urllib3 Retry with a jittered exponential backoff, so that many workers
+    failing at the same time do not hit the host again all together.
+    """
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(backoff / 2, backoff)
 
-def DownloadData(url):
-    # data
+def get_http_session():
+    """
+    Return the HTTP session shared by all the upstream calls.
+
+    The session keeps a keep-alive connection pool per host and retries
+    connection errors and transient 5xx responses with a jittered
+    exponential backoff.
+    """
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            retry = JitteredRetry(
+                total=args.http_retries,
+                backoff_factor=args.http_backoff,
+                status_forcelist=HTTP_RETRY_STATUS,
+                allowed_methods=frozenset(['GET']),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(10, args.workers), max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            http_session = session
+    return http_session
+
+class HostUnavailableError(requests.exceptions.ConnectionError):
+    """
+    A request not sent because the circuit breaker of its host is open.
+    """
+
+class HostPolicy:
+    """
+    Token-bucket rate limit, cap on the requests in flight and circuit
+    breaker of the requests to an upstream host.
+
+    After --breaker-failures consecutive failures (connection errors,
+    timeouts or 5xx answers, once the retries are exhausted) the breaker
+    opens: the requests to the host fail at once for --breaker-cooldown
+    seconds, then a single probe request is let through, which closes the
+    breaker if it succeeds or opens it again if it fails.
+    """
+
+    def __init__(self, host, rate, max_in_flight, failure_threshold, cooldown):
+        self.host = host
+        self.rate = rate
+        self.burst = max(1., rate)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.failures = 0
+        self.open_until = None
+        self.probing = False
+
+    def acquire_token(self):
+        """
+        Wait for a token of the rate limit; 0 means no limit.
+        """
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # the token is taken now, the wait is done out of the lock
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.
+        if wait > 0:
+            time.sleep(wait)
+
+    def allow(self):
+        """
+        Tell whether a request can be sent, i.e. the breaker is closed, or this
+        is the probe request after the cool-down.
+        """
+        with self.lock:
+            if self.open_until is None:
+                return True
+            if time.monotonic() < self.open_until or self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, success):
+        with self.lock:
+            self.probing = False
+            if success:
+                if self.open_until is not None:
+                    logger.info(f"\t\thost {self.host} is answering again, circuit breaker closed".expandtabs(TAB_SIZE))
+                self.failures = 0
+                self.open_until = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.open_until is None:
+                    logger.warning(f"\t\thost {self.host}: {self.failures} consecutive failures, circuit breaker open, requests skipped for {self.cooldown:.0f}s".expandtabs(TAB_SIZE))
+                    metrics.count('breaker_trips')
+                self.open_until = time.monotonic() + self.cooldown
+
+def get_host_policy(host):
+    with host_policies_lock:
+        policy = host_policies.get(host)
+        if policy is None:
+            policy = HostPolicy(host, args.host_rate, args.host_max_in_flight, args.breaker_failures, args.breaker_cooldown)
+            host_policies[host] = policy
+    return policy
+
+@contextlib.contextmanager
+def http_stream(url, headers=None):
+    """
+    GET url through the shared session, using the configured connect and read
+    timeouts and the rate limit, concurrency cap and circuit breaker of the
+    host, and yield the response with its body still to be read.
+
+    The request keeps its slot of --host-max-in-flight until the block ends:
+    its time includes the transfer of the body, and an error raised while
+    reading it counts as a failure of the host. The caller records the bytes
+    of the body with metrics.add_bytes.
+
+    Raises:
+        Connection errors and timeouts, once the retries are exhausted;
+        HostUnavailableError when the breaker of the host is open.
+    """
+    host = urlsplit(url).hostname
+    policy = get_host_policy(host)
+    if not policy.allow():
+        metrics.count('breaker_skipped_requests')
+        raise HostUnavailableError(f"circuit breaker open for host {host}")
+    policy.acquire_token()
+    with policy.in_flight:
+        t0 = time.perf_counter()
+        status = None
+        try:
+            r = get_http_session().get(url, headers=headers, timeout=(args.connect_timeout, args.read_timeout), stream=True)
+            with contextlib.closing(r):
+                yield r
+            status = r.status_code
+        except Exception:
+            policy.record(False)
+            raise
+        finally:
+            metrics.add_request(host, time.perf_counter() - t0, 0, status)
+    policy.record(status < 500)
+
+def http_get(url, headers=None):
+    """
+    GET url as http_stream, reading the whole body.
+
+    Returns:
+        requests.Response. Connection errors and timeouts are raised once the
+        retries are exhausted; HostUnavailableError when the breaker of the host is open.
+    """
+    with http_stream(url, headers) as r:
+        metrics.add_bytes(urlsplit(url).hostname, len(r.content))
+    return r
+
+class StreamingFingerprint:
+    """
+    SHA-256 of a download, computed chunk by chunk after stripping the
+    attributes that change on every request ('created', 'downloaded').
+    """
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.pending = b''
+
+    def update(self, chunk):
+        data = self.pending + chunk
+        # the volatile attributes are inside a tag: the data up to the last '>'
+        # can be stripped, the rest waits for the next chunk
+        cut = data.rfind(b'>') + 1
+        if not cut and len(data) > DOWNLOAD_SPOOL_SIZE:
+            cut = len(data)
+        self.sha256.update(VOLATILE_ATTRS_RE.sub(b'', data[:cut]))
+        self.pending = data[cut:]
+
+    def hexdigest(self):
+        self.sha256.update(VOLATILE_ATTRS_RE.sub(b'', self.pending))
+        self.pending = b''
+        return self.sha256.hexdigest()
+
+class XmlFingerprint:
+    """
+    Canonical SHA-256 of an XML document, computed from its parse events:
+    two documents have the same fingerprint when xml_elements_equal() holds
+    for their roots (same tags, attributes apart from ignore_attrs, stripped
+    texts and children, in order).
+
+    The content of an element is released once hashed; only its tail is
+    kept, until its parent ends, so memory does not grow with the document.
+    """
+
+    def __init__(self, ignore_attrs=VOLATILE_XML_ATTRS):
+        self.ignore_attrs = ignore_attrs
+        # (element, digest) of the children of the open elements
+        self.children = [[]]
+
+    def feed(self, events):
+        """
+        Hash the ('start' | 'end', element) events of an iterparse or XMLPullParser.
+        """
+        for event, element in events:
+            if event == 'start':
+                self.children.append([])
+                continue
+            attrs = sorted((k, v) for k, v in element.attrib.items() if k.rsplit('}', 1)[-1] not in self.ignore_attrs)
+            sha256 = hashlib.sha256(json.dumps([element.tag, attrs, (element.text or '').strip()]).encode())
+            for child, digest in self.children.pop():
+                sha256.update(json.dumps([digest, (child.tail or '').strip()]).encode())
+            self.children[-1].append((element, sha256.hexdigest()))
+            del element[:]
+            element.attrib.clear()
+            element.text = None
+
+    def hexdigest(self):
+        return self.children[0][0][1]
+
+class _EventTreeBuilder(ET.TreeBuilder):
+    """
+    TreeBuilder recording the ('start' | 'end', element) events (see Utf8PullParser).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def start(self, tag, attrs):
+        element = super().start(tag, attrs)
+        self.events.append(('start', element))
+        return element
+
+    def end(self, tag):
+        element = super().end(tag)
+        self.events.append(('end', element))
+        return element
+
+class Utf8PullParser:
+    """
+    Like ET.XMLPullParser(events=('start', 'end')), but always decoding the
+    document as UTF-8, as parse_xml does.
+    """
+
+    def __init__(self):
+        self.builder = _EventTreeBuilder()
+        self.parser = ET.XMLParser(target=self.builder, encoding='utf-8')
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+    def close(self):
+        self.parser.close()
+
+    def read_events(self):
+        events, self.builder.events = self.builder.events, []
+        return events
+
+def feed_xml_fingerprint(xml_fingerprint, parser, chunk, url):
+    """
+    Parse a chunk of a download (None at its end) into its XmlFingerprint.
+
+    Returns:
+        The XmlFingerprint, or None once the download is found malformed.
+    """
     try:
-        r = requests.get(url)
-        if r.status_code == 200:
-            return r.content
+        if chunk is None:
+            parser.close()
         else:
-            logger.info(f"\t\treturn: [{r.status_code}]".expandtabs(TAB_SIZE))
-            return None
-    except:
-        logger.error (f"\t\tevent_dat problems with url: [{url}] status_dat forced to 204".expandtabs(TAB_SIZE))
+            parser.feed(chunk)
+        xml_fingerprint.feed(parser.read_events())
+        return xml_fingerprint
+    except ET.ParseError as e:
+        logger.warning(f"\t\tmalformed XML from url: [{url}]: {str(e)}".expandtabs(TAB_SIZE))
+        metrics.count('malformed_downloads')
         return None
 
-def DownloadDataWithAuth(url, token):
+def xml_ignored_attrs(FileFullPath):
+    """
+    Attributes ignored when comparing a downloaded XML file with the saved one.
+    """
+    if '_REPORTED-INTENSITY_dat.xml.test' in FileFullPath:
+        # regenerated on every request, and carrying no meaningful information
+        return VOLATILE_XML_ATTRS | {'downloaded'}
+    return VOLATILE_XML_ATTRS
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_manifest():
+    global manifest
+    with manifest_lock:
+        if manifest is None:
+            manifest = {} if args.force_download else load_state(MANIFEST_STATE, {})
+    return manifest
+
+def set_manifest_entry(FileFullPath, entry):
+    get_manifest()[os.path.relpath(FileFullPath, args.git_repo_dir)] = entry
+
+def save_manifest():
+    if manifest is not None:
+        save_state(MANIFEST_STATE, manifest)
+
+def save_run_state():
+    """
+    Save the caches and indexes updated during the run.
+    """
+    save_manifest()
+    save_locstring_cache()
+    save_resolved_events()
+    save_negative_cache()
+    save_refresh_schedule()
+    if event_index is not None:
+        event_index.commit()
+    if station_store is not None:
+        station_store.commit()
+
+def DownloadIfChanged(url, FileFullPath, variant='', headers=None):
+    """
+    Download url as the new content of FileFullPath, skipping the work when
+    the upstream data has not changed since the last saved download.
+
+    A conditional request (If-None-Match / If-Modified-Since) is sent when
+    the manifest has the ETag or Last-Modified of the previous download; a
+    304 answer or a body with the same fingerprint returns no data. The
+    manifest is only trusted while the file on disk is still the one saved
+    from that download (see save_event_xml_data).
+
+    The body is streamed: in one pass it is fingerprinted, checked against
+    --max-download-size, parsed incrementally when an XML file is expected
+    (a malformed body has no XmlFingerprint: saveIfChanged compares it as
+    it can) and spooled to a temporary file, so it is only read in memory
+    when it has changed.
+
+    Args:
+        url (str): The URL to download.
+        FileFullPath (str): The file the data is saved to.
+        variant (str): Options the saved file depends on, besides the download.
+        headers (dict): Additional request headers.
+
+    Returns:
+        Download: status, data (None if failed or unchanged) and manifest entry.
+    """
+    entry = get_manifest().get(os.path.relpath(FileFullPath, args.git_repo_dir))
+    if entry and (entry.get('url') != url or entry.get('variant') != variant or not os.path.isfile(FileFullPath)):
+        entry = None
+    # the file was changed by a pull or by hand since it was saved
+    if entry and entry.get('output_sha256') != file_sha256(FileFullPath):
+        entry = None
+
+    request_headers = dict(headers or {})
+    if entry and entry.get('etag'):
+        request_headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('last_modified'):
+        request_headers['If-Modified-Since'] = entry['last_modified']
+
     try:
-        headers = {'Authorization': f'Bearer {token}'}
-        r = requests.get(url, headers=headers)
-        if r.status_code == 200:
-            return r.content
-        else:
-            logger.warning(f"\t\treturn: [{r.status_code}]".expandtabs(TAB_SIZE))
-            return None
-    except:
-        logger.warning(f"\t\treported intensity problems with url: [{url}]".expandtabs(TAB_SIZE))
-        return None
+        with http_stream(url, headers=request_headers) as r:
+            if r.status_code == 304 and entry:
+                logger.info(f"\t\treturn: [304], not modified".expandtabs(TAB_SIZE))
+                return Download(304, None, None)
+            if r.status_code != 200:
+                logger.info(f"\t\treturn: [{r.status_code}]".expandtabs(TAB_SIZE))
+                return Download(r.status_code, None, None)
+            return read_download(r, url, FileFullPath, variant, entry)
+    except Exception as e:
+        logger.error(f"\t\tproblems with url: [{url}]: {str(e)}".expandtabs(TAB_SIZE))
+        return Download(None, None, None)
+
+def read_download(r, url, FileFullPath, variant, entry):
+    """
+    Read the body of a streamed 200 response for DownloadIfChanged; errors
+    while reading it are raised, so that the host policy counts them.
+    """
+    max_size = int(args.max_download_size * 1024 * 1024)
+    length = r.headers.get('Content-Length')
+    if length and length.isdigit() and int(length) > max_size:
+        logger.error(f"\t\tdownload too large: {int(length)} bytes, more than --max-download-size".expandtabs(TAB_SIZE))
+        metrics.count('downloads_too_large')
+        return Download(None, None, None)
+
+    fingerprint = StreamingFingerprint()
+    # the XML is fingerprinted while parsed, so that saveIfChanged does not parse it again
+    if FileFullPath.endswith(('.xml', '.xml.test')):
+        parser = Utf8PullParser()
+        xml_fingerprint = XmlFingerprint(xml_ignored_attrs(FileFullPath))
+    else:
+        parser = xml_fingerprint = None
+    size = 0
+    with tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE) as spool:
+        try:
+            for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    logger.error(f"\t\tdownload too large: more than {max_size} bytes, --max-download-size".expandtabs(TAB_SIZE))
+                    metrics.count('downloads_too_large')
+                    return Download(None, None, None)
+                fingerprint.update(chunk)
+                spool.write(chunk)
+                if xml_fingerprint is not None:
+                    xml_fingerprint = feed_xml_fingerprint(xml_fingerprint, parser, chunk, url)
+            if xml_fingerprint is not None:
+                xml_fingerprint = feed_xml_fingerprint(xml_fingerprint, parser, None, url)
+        finally:
+            metrics.add_bytes(urlsplit(url).hostname, size)
+
+        new_entry = {
+            'url': url,
+            'variant': variant,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'sha256': fingerprint.hexdigest(),
+        }
+        if entry and entry.get('sha256') == new_entry['sha256']:
+            logger.info(f"\t\tcontent unchanged since last download".expandtabs(TAB_SIZE))
+            return Download(200, None, new_entry)
+        spool.seek(0)
+        return Download(200, spool.read(), new_entry, xml_fingerprint.hexdigest() if xml_fingerprint else None)
+
+def get_negative_cache():
+    global negative_cache
+    with negative_cache_lock:
+        if negative_cache is None:
+            negative_cache = load_state(NEGATIVE_CACHE_STATE, {})
+    return negative_cache
+
+def save_negative_cache():
+    if negative_cache is not None:
+        # drop the answers expired since longer than the maximum TTL, so that
+        # the file does not grow forever: the back-off starts again from scratch
+        keep = args.negative_cache_max_ttl * 60
+        now = time.time()
+        with negative_cache_lock:
+            for event_id, entry in list(negative_cache.items()):
+                sources = entry['sources']
+                for source in [k for k, v in sources.items() if now - v['until'] > keep]:
+                    del sources[source]
+                if not sources:
+                    del negative_cache[event_id]
+        save_state(NEGATIVE_CACHE_STATE, negative_cache)
+
+def event_origin(record):
+    """
+    Fingerprint of the catalog origin of an event: a change of time, location
+    or magnitude can make upstream data available.
+    """
+    time_ = record.time.strftime(TIME_FORMAT) if record.time is not None else None
+    return f"{time_}|{record.latitude}|{record.longitude}|{record.depth}|{record.magnitude}"
+
+def invalidate_negative_cache(events, updated_ids=None):
+    """
+    Forget the "no data" answers of the events updated by ESM, and of the
+    events whose catalog origin changed since the answers were cached.
+
+    Args:
+        events (list): EventRecord of the events of the cycle.
+        updated_ids (list): IDs of the events updated by ESM (see find_updated_events).
+    """
+    if args.negative_cache_ttl <= 0:
+        return
+    cache = get_negative_cache()
+    negative_cache_origins.clear()
+    cleared = []
+    with negative_cache_lock:
+        for event_id in updated_ids or []:
+            if cache.pop(event_id, None) is not None:
+                cleared.append(event_id)
+        for record in events:
+            # an event of the repository not looked up has no origin (see resolve_event_ids)
+            if record.time is None:
+                continue
+            origin = event_origin(record)
+            negative_cache_origins[record.event_id] = origin
+            entry = cache.get(record.event_id)
+            if entry is None:
+                continue
+            if entry.get('origin') is None:
+                entry['origin'] = origin
+            elif entry['origin'] != origin:
+                del cache[record.event_id]
+                cleared.append(record.event_id)
+    if cleared:
+        logger.info(f"\tnegative cache cleared for the updated events: {cleared}".expandtabs(TAB_SIZE))
+
+def DownloadUnlessNoData(event_id, source, url, FileFullPath, variant='', headers=None):
+    """
+    DownloadIfChanged, unless the source recently answered that it has no data
+    for the event.
 
+    Each consecutive "no data" answer (NEGATIVE_CACHE_STATUS) doubles the time
+    the source is not asked again for the event, from --negative-cache-ttl up
+    to --negative-cache-max-ttl; any other answer clears it. Connection errors
+    and 5xx responses are not cached, they are retried at the next run.
+
+    Args:
+        event_id (str): The event ID.
+        source (str): The upstream source, e.g. 'esm_dat' or 'rrsm_event'.
+        url, FileFullPath, variant, headers: As in DownloadIfChanged.
+
+    Returns:
+        Download: as DownloadIfChanged; the cached status, with no data, when skipped.
+    """
+    if args.negative_cache_ttl <= 0 or args.force_download:
+        return DownloadIfChanged(url, FileFullPath, variant, headers)
+
+    cache = get_negative_cache()
+    with negative_cache_lock:
+        cached = cache.get(event_id, {}).get('sources', {}).get(source)
+    if cached is not None and time.time() < cached['until']:
+        until = datetime.fromtimestamp(cached['until'], timezone.utc).strftime(TIME_FORMAT)
+        logger.info(f"\t\tskipped: returned [{cached['status']}] {cached['count']} time(s), not asked again until {until}".expandtabs(TAB_SIZE))
+        metrics.count('negative_cache_hits')
+        return Download(cached['status'], None, None)
+
+    download = DownloadIfChanged(url, FileFullPath, variant, headers)
+    with negative_cache_lock:
+        if download.status in NEGATIVE_CACHE_STATUS:
+            count = cached['count'] + 1 if cached is not None else 1
+            ttl = min(args.negative_cache_ttl * 2 ** min(count - 1, 30), args.negative_cache_max_ttl) * 60
+            entry = cache.setdefault(event_id, {'origin': negative_cache_origins.get(event_id), 'sources': {}})
+            entry['sources'][source] = {'status': download.status, 'count': count, 'until': time.time() + ttl}
+        elif download.status is not None and download.status < 500 and cached is not None:
+            sources = cache.get(event_id, {}).get('sources', {})
+            sources.pop(source, None)
+            if not sources:
+                cache.pop(event_id, None)
+        if cache_journal is not None:
+            entry = cache.get(event_id)
+            cache_journal['negative'][event_id] = json.loads(json.dumps(entry)) if entry is not None else None
+    return download
+
+def get_locstring_cache():
+    global locstring_cache
+    with locstring_cache_lock:
+        if locstring_cache is None:
+            locstring_cache = load_state(LOCSTRING_CACHE_STATE, {})
+    return locstring_cache
+
+def save_locstring_cache():
+    if locstring_cache is not None:
+        # drop the expired entries, so that the file does not grow forever
+        ttl = args.locstring_cache_ttl * ONEDAY
+        now = time.time()
+        with locstring_cache_lock:
+            for key in [k for k, v in locstring_cache.items() if now - v['time'] > ttl]:
+                del locstring_cache[key]
+        save_state(LOCSTRING_CACHE_STATE, locstring_cache)
 
 def get_locstring(lat, lon, mode):
+    """
+    Get the location string for the given coordinates, from the on-disk
+    cache when possible, otherwise from the INGV boundaries web service.
+
+    Coordinates are rounded to --locstring-cache-precision decimals; "no
+    result" answers are cached as well, failed requests are not.
+
+    Args:
+        lat (str or float): Latitude.
+        lon (str or float): Longitude.
+        mode (str): 'region_name' or 'boundary'.
+
+    Returns:
+        str or None: The location string, or None if the request fails.
+    """
+    if mode == 'boundary' and args.locstring_engine == 'offline':
+        try:
+            result = str(get_flinn_engdahl_grid().lookup(float(lat), float(lon)))
+        except ValueError:
+            return None
+        if result:
+            logger.info(f"\t\tlocstring result (offline): {result}".expandtabs(TAB_SIZE))
+            return result
+        # region left unlabelled in the grid: ask the service
+        logger.info(f"\t\tlocstring ({mode}) not in the offline grid: remote lookup".expandtabs(TAB_SIZE))
+
+    if args.locstring_cache_ttl <= 0:
+        return request_locstring(lat, lon, mode)[1]
+
+    precision = args.locstring_cache_precision
+    try:
+        key = f"{mode}:{float(lat):.{precision}f}:{float(lon):.{precision}f}"
+    except ValueError:
+        return request_locstring(lat, lon, mode)[1]
+
+    cache = get_locstring_cache()
+    cached = cache.get(key)
+    if cached is not None and time.time() - cached['time'] <= args.locstring_cache_ttl * ONEDAY:
+        logger.info(f"\t\tlocstring ({mode}) from cache: {cached['value']}".expandtabs(TAB_SIZE))
+        return cached['value']
+
+    answered, result = request_locstring(lat, lon, mode)
+    if answered:
+        with locstring_cache_lock:
+            cache[key] = {'value': result, 'time': time.time()}
+            if cache_journal is not None:
+                cache_journal['locstring'][key] = cache[key]
+    return result
+
+class FlinnEngdahlGrid:
+    """
+    Flinn-Engdahl 1996 regionalization as a precomputed one-degree grid.
+
+    The regionalization is defined on one-degree cells, numbered from the
+    equator and the Greenwich meridian in each quadrant, so a lookup is just
+    an array index: regions[south, west, int(|lat|), int(|lon|)] is the
+    position of the region name in names.
+    """
+
+    def __init__(self, regions, names):
+        self.regions = regions
+        self.names = names
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        with np.load(path, allow_pickle=False) as npz:
+            return cls(npz['regions'], npz['names'].astype(object))
+
+    def save(self, path):
+        import numpy as np
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, regions=self.regions, names=self.names.astype(str))
+        os.replace(tmp_path, path)
+
+    def lookup(self, lats, lons):
+        """
+        Return the region names of many points at once.
+
+        Args:
+            lats (array-like): Latitudes in degrees.
+            lons (array-like): Longitudes in degrees.
+
+        Returns:
+            numpy.ndarray: Region names, with the shape of lats.
+        """
+        import numpy as np
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        lons = np.where(np.abs(lons) > 180, (lons + 180) % 360 - 180, lons)
+        south = (lats < 0).astype(np.intp)
+        west = (lons < 0).astype(np.intp)
+        ilat = np.minimum(np.abs(lats).astype(np.intp), 90)
+        ilon = np.minimum(np.abs(lons).astype(np.intp), 180)
+        return self.names[self.regions[south, west, ilat, ilon]]
+
+def build_flinn_engdahl_grid():
+    """
+    Build the Flinn-Engdahl grid from the obspy regionalization tables.
+
+    Each distinct region is labelled once through the INGV boundary service,
+    so that offline and remote locstrings are identical; a region the service
+    does not label is left unlabelled (empty name), and looked up remotely
+    when needed.
+
+    Returns:
+        FlinnEngdahlGrid
+    """
+    import numpy as np
+    from obspy.geodetics import FlinnEngdahl
+    logger.info("Building the Flinn-Engdahl grid")
+    fe = FlinnEngdahl()
+    regions = np.zeros((2, 2, 91, 181), dtype=np.int16)
+    fe_names = []
+    index = {}
+    centers = []
+    for south in (0, 1):
+        for west in (0, 1):
+            for ilat in range(91):
+                # cell centers; the cells on the pole and the antimeridian repeat the previous ones
+                lat = min(ilat + 0.5, 89.999) * (-1 if south else 1)
+                for ilon in range(181):
+                    lon = min(ilon + 0.5, 179.999) * (-1 if west else 1)
+                    name = fe.get_region(lon, lat)
+                    if name not in index:
+                        index[name] = len(fe_names)
+                        fe_names.append(name)
+                        centers.append((lat, lon))
+                    regions[south, west, ilat, ilon] = index[name]
+
+    names = []
+    for fe_name, (lat, lon) in zip(fe_names, centers):
+        answered, label = request_locstring(f"{lat:.4f}", f"{lon:.4f}", 'boundary')
+        if not (answered and label):
+            logger.warning(f"\tFlinn-Engdahl region '{fe_name}' ({lat}, {lon}) left unlabelled: no answer from the boundary service".expandtabs(TAB_SIZE))
+            label = ''
+        names.append(label)
+    unlabelled = names.count('')
+    logger.info(f"Flinn-Engdahl grid built: {len(names)} regions, {unlabelled} unlabelled")
+    return FlinnEngdahlGrid(regions, np.array(names, dtype=object))
+
+def get_flinn_engdahl_grid(rebuild=False):
+    """
+    Load the Flinn-Engdahl grid from --state-dir, building it the first time.
+    """
+    global flinn_engdahl_grid
+    with flinn_engdahl_grid_lock:
+        if flinn_engdahl_grid is None or rebuild:
+            path = os.path.join(args.state_dir, FLINN_ENGDAHL_GRID_STATE)
+            if os.path.isfile(path) and not rebuild:
+                flinn_engdahl_grid = FlinnEngdahlGrid.load(path)
+            else:
+                flinn_engdahl_grid = build_flinn_engdahl_grid()
+                flinn_engdahl_grid.save(path)
+    return flinn_engdahl_grid
+
+def relabel_locstrings():
+    """
+    Set the locstring of every event.xml in the repository from the offline
+    Flinn-Engdahl grid, in one vectorized pass, and commit the changed files.
+    """
+    event_files = sorted(Path(args.git_repo_dir, 'data').glob('*/*/current/event.xml'))
+    roots = []
+    for FileFullPath in event_files:
+        try:
+            roots.append(parse_xml(FileFullPath.read_bytes()))
+        except ET.ParseError as e:
+            logger.warning(f"\t{FileFullPath} skipped: {str(e)}".expandtabs(TAB_SIZE))
+            roots.append(None)
+
+    def coordinate(root, name):
+        try:
+            return float(root.attrib[name])
+        except (AttributeError, KeyError, ValueError):
+            return float('nan')
+
+    lats = [coordinate(root, 'lat') for root in roots]
+    lons = [coordinate(root, 'lon') for root in roots]
+    valid = [lat == lat and lon == lon for lat, lon in zip(lats, lons)]
+    locstrings = get_flinn_engdahl_grid().lookup([lat if ok else 0. for lat, ok in zip(lats, valid)],
+                                                 [lon if ok else 0. for lon, ok in zip(lons, valid)])
+    logger.info(f"RELABELING {len(event_files)} event.xml FILES")
+
+    changed = 0
+    for FileFullPath, root, ok, locstring in zip(event_files, roots, valid, locstrings):
+        if not ok or root.attrib.get('locstring', '') == locstring:
+            continue
+        if not locstring:
+            logger.warning(f"\t{FileFullPath} skipped: region not labelled in the Flinn-Engdahl grid".expandtabs(TAB_SIZE))
+            continue
+        relative_path = os.path.relpath(FileFullPath, args.git_repo_dir)
+        result, author = check_repository_file(relative_path)
+        if not result:
+            logger.warning(f"\t{relative_path} skipped because modified by the external user: {author}".expandtabs(TAB_SIZE))
+            continue
+        event_id = FileFullPath.parent.parent.name
+        logger.info(f"\t{event_id}: replacing locstring '{root.attrib.get('locstring', '')}' with '{locstring}'".expandtabs(TAB_SIZE))
+        root.attrib['locstring'] = str(locstring)
+        data = ET.tostring(root, encoding='utf8')
+        writeFile(data, str(FileFullPath))
+        index_event_file(str(FileFullPath), data)
+        commit_file(str(FileFullPath), f"Update event={event_id}", event_id)
+        changed += 1
+    logger.info(f"{changed} event.xml file(s) relabeled")
+
+def request_locstring(lat, lon, mode):
     """
     Query the INGV boundaries web service to get a location string
     for the given coordinates.
@@ -305,7 +1480,8 @@ def get_locstring(lat, lon, mode):
         mode (str): 'region_name' or 'boundary'.
 
     Returns:
-        str or None: The location string, or None if the request fails.
+        tuple: (answered, result); answered is False if the request fails,
+        result is the location string or None.
     """
     if mode == 'region_name':
         url = f"{INGV_BOUNDARIES_BASE_URL}/region_name/1/?lat={lat}&lon={lon}&limit=4000&format=json"
@@ -313,11 +1489,11 @@ def get_locstring(lat, lon, mode):
         url = f"{INGV_BOUNDARIES_BASE_URL}/boundary/1/?lat={lat}&lon={lon}&boundary_type=flinn_engdahl_1996&includegeometry=false&limit=4000&format=json"
     else:
         logger.error(f"\t\tget_locstring: unknown mode '{mode}'".expandtabs(TAB_SIZE))
-        return None
+        return False, None
 
     logger.info(f"\t\trequest locstring ({mode}) on: {url}".expandtabs(TAB_SIZE))
     try:
-        r = requests.get(url)
+        r = http_get(url)
         if r.status_code == 200:
             resp = r.json()
 
@@ -337,13 +1513,13 @@ def get_locstring(lat, lon, mode):
                 logger.info(f"\t\tlocstring result: {result}".expandtabs(TAB_SIZE))
             else:
                 logger.warning(f"\t\tlocstring: no result found in response".expandtabs(TAB_SIZE))
-            return result
+            return True, result
         else:
             logger.info(f"\t\tlocstring request returned: [{r.status_code}]".expandtabs(TAB_SIZE))
-            return None
+            return False, None
     except Exception as e:
         logger.error(f"\t\tlocstring request failed: {str(e)}".expandtabs(TAB_SIZE))
-        return None
+        return False, None
 
 
 # extract ID from event string
@@ -372,6 +1548,7 @@ def extract_id(string, fdsn_client):
 
     return event_id
 
+@timed('clean_event_data', nbytes=lambda result, xmlstring: data_size(xmlstring))
 def clean_event_data(xmlstring):
     netid = "IV"
     network = "INGV-ONT"
@@ -392,7 +1569,8 @@ def clean_event_data(xmlstring):
     return ET.tostring(root, encoding='utf8')
 
 
-def update_event_xml(data_event, event_id):
+@timed('update_event_xml', nbytes=lambda result, data_event, event_id: data_size(data_event))
+def update_event_xml(data_event, event_id, failures=None):
     """
     Optionally update the 'id' and 'locstring' attributes of the event XML
     based on the -u/--update-eventid and -r/--update-locstring flags.
@@ -400,6 +1578,7 @@ def update_event_xml(data_event, event_id):
     Args:
         data_event (bytes): The event XML data.
         event_id (str): The event ID used in the GET request.
+        failures (list): if given, the updates that could not be made are appended to it.
 
     Returns:
         bytes: The (possibly modified) event XML data.
@@ -437,6 +1616,8 @@ def update_event_xml(data_event, event_id):
                     logger.info(f"\t\tupdate-locstring ({args.update_locstring}): locstring already matches '{locstring_value}', no change needed".expandtabs(TAB_SIZE))
             else:
                 logger.warning(f"\t\tupdate-locstring ({args.update_locstring}): could not retrieve locstring for lat={lat}, lon={lon}".expandtabs(TAB_SIZE))
+                if failures is not None:
+                    failures.append('locstring')
         else:
             logger.warning(f"\t\tupdate-locstring: lat or lon missing from event XML".expandtabs(TAB_SIZE))
 
@@ -445,21 +1626,80 @@ def update_event_xml(data_event, event_id):
     return data_event
 
 
-def diff(xmlstring, xml_file):
-    f = NamedTemporaryFile(delete=False)
-    f.write(xmlstring)
-    path = f.name
-    f.close()
-    diff = main.diff_files(path, xml_file, {'ratio_mode': 'faster', 'fast_match': True} )
-    os.unlink(path)
+def parse_xml(xmlstring):
+    """
+    Parse an XML document, always decoding it as UTF-8: the files written by
+    ET.tostring(..., encoding='utf8') declare encoding='utf8', an alias that
+    expat rejects as soon as the document has non-ASCII characters.
+    """
+    return ET.fromstring(xmlstring, parser=ET.XMLParser(encoding='utf-8'))
 
-    if len(diff) == 0:
+def xml_elements_equal(e1, e2, ignore_attrs):
+    """
+    Compare two ElementTree elements (tag, attributes, stripped text and
+    children, in order), skipping the attributes whose local name is in
+    ignore_attrs.
+    """
+    if e1.tag != e2.tag or len(e1) != len(e2):
         return False
-    if len(diff) == 1 and diff[0].name == 'created':
+    if (e1.text or '').strip() != (e2.text or '').strip() or (e1.tail or '').strip() != (e2.tail or '').strip():
         return False
-    return True
+    if e1.attrib != e2.attrib:
+        attrs1 = {k: v for k, v in e1.attrib.items() if k.rsplit('}', 1)[-1] not in ignore_attrs}
+        attrs2 = {k: v for k, v in e2.attrib.items() if k.rsplit('}', 1)[-1] not in ignore_attrs}
+        if attrs1 != attrs2:
+            return False
+    return all(xml_elements_equal(c1, c2, ignore_attrs) for c1, c2 in zip(e1, e2))
+
+def xml_equal(xmlstring1, xmlstring2, ignore_attrs=VOLATILE_XML_ATTRS):
+    """
+    Tell whether two XML documents have the same content, apart from the
+    attributes in ignore_attrs.
+
+    Args:
+        xmlstring1 (bytes): First XML document.
+        xmlstring2 (bytes): Second XML document.
+        ignore_attrs (set): Attribute names (without namespace) to ignore.
+
+    Returns:
+        bool: True if the documents are equivalent. Documents that cannot
+        be parsed are equivalent only if they are byte-identical.
+    """
+    if xmlstring1 == xmlstring2:
+        return True
+    try:
+        root1 = parse_xml(xmlstring1)
+        root2 = parse_xml(xmlstring2)
+    except ET.ParseError:
+        return False
+    return xml_elements_equal(root1, root2, ignore_attrs)
+
+@timed('diff', nbytes=lambda result, xmlstring, *args, **kwargs: data_size(xmlstring))
+def diff(xmlstring, xml_file, ignore_attrs=VOLATILE_XML_ATTRS):
+    with open(xml_file, 'rb') as f:
+        existing = f.read()
+    return not xml_equal(xmlstring, existing, ignore_attrs)
 
 
+@timed('fingerprint', nbytes=lambda result, path, *args, **kwargs: data_size(path))
+def xml_file_fingerprint(path, ignore_attrs=VOLATILE_XML_ATTRS):
+    """
+    Return the XmlFingerprint of an XML file, parsed incrementally.
+
+    Raises:
+        xml.etree.ElementTree.ParseError: if the document is not well-formed.
+    """
+    fingerprint = XmlFingerprint(ignore_attrs)
+    parser = Utf8PullParser()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            parser.feed(chunk)
+            fingerprint.feed(parser.read_events())
+    parser.close()
+    fingerprint.feed(parser.read_events())
+    return fingerprint.hexdigest()
+
+@timed('diff_ignoring_attrs', nbytes=lambda result, xmlstring, *args, **kwargs: data_size(xmlstring))
 def diff_ignoring_attrs(xmlstring, xml_file, ignore_attrs):
     """
     Like diff(), but ignores changes to specified XML attribute names.
@@ -467,48 +1707,474 @@ def diff_ignoring_attrs(xmlstring, xml_file, ignore_attrs):
       - has_meaningful_changes: True if structural or non-ignored attribute changes exist
       - only_ignored_changes: True if the only differences are in the ignored attributes
     """
-    f = NamedTemporaryFile(delete=False)
-    f.write(xmlstring)
-    path = f.name
-    f.close()
-    diff_result = main.diff_files(path, xml_file, {'ratio_mode': 'faster', 'fast_match': True})
-    os.unlink(path)
-
-    if len(diff_result) == 0:
+    with open(xml_file, 'rb') as f:
+        existing = f.read()
+    if xmlstring == existing:
         return False, False
-    if len(diff_result) == 1 and diff_result[0].name == 'created':
+    try:
+        root1 = parse_xml(xmlstring)
+        root2 = parse_xml(existing)
+    except ET.ParseError:
+        return True, False
+
+    if xml_elements_equal(root1, root2, VOLATILE_XML_ATTRS):
         return False, False
+    if xml_elements_equal(root1, root2, VOLATILE_XML_ATTRS | set(ignore_attrs)):
+        return False, True
+    return True, False
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def iter_stationlist(source, ignore_attrs=VOLATILE_XML_ATTRS):
+    """
+    Parse a <stationlist> document incrementally.
+
+    Yields (key, value) pairs: first (None, root attributes), then one pair
+    for each child of the root. Stations are keyed by 'netid.code' and their
+    value holds the station attributes and, for each component (keyed by
+    'name'), the component attributes and the attributes of its values
+    (acc, vel, psaNN, ...); the other children are keyed by '<tag>' and
+    their value is their XmlFingerprint. Processed elements are released,
+    so memory does not grow with the document size.
+
+    Args:
+        source (str or file object): The XML file.
+        ignore_attrs (set): Attribute names (without namespace) to ignore.
+    """
+    def attributes(elem):
+        return tuple(sorted((_local_name(k), v) for k, v in elem.attrib.items() if _local_name(k) not in ignore_attrs))
+
+    depth = 0
+    root = None
+    seen = {}
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+                yield None, attributes(elem)
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if _local_name(elem.tag) == 'station':
+            key = f"{elem.get('netid', '')}.{elem.get('code', '')}"
+            comps = {}
+            for comp in elem:
+                comp_key = comp.get('name', _local_name(comp.tag))
+                while comp_key in comps:
+                    comp_key += '#'
+                comps[comp_key] = (attributes(comp), tuple(sorted((_local_name(v.tag), attributes(v)) for v in comp)))
+            value = (attributes(elem), comps)
+        else:
+            key = f"<{_local_name(elem.tag)}>"
+            fingerprint = XmlFingerprint(ignore_attrs)
+            fingerprint.feed(element_events(elem))
+            value = fingerprint.hexdigest()
+        # keep duplicated keys apart
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > 1:
+            key = f"{key}#{seen[key]}"
+        yield key, value
+        root.remove(elem)
+
+def element_events(elem):
+    """
+    The ('start' | 'end', element) events of a parsed element and its children, in document order.
+    """
+    yield 'start', elem
+    for child in elem:
+        yield from element_events(child)
+    yield 'end', elem
+
+class StationListDiff:
+    """
+    What changed between two station lists (see diff_stationlists).
+    """
+
+    # maximum number of stations listed for each kind of change
+    MAX_LISTED = 20
+
+    def __init__(self):
+        self.attributes_changed = False
+        self.added = []
+        self.removed = []
+        self.changed = []
+
+    def __bool__(self):
+        return bool(self.attributes_changed or self.added or self.removed or self.changed)
+
+    def summary(self):
+        """
+        Return a short, multi-line description of the changes.
+        """
+        def listed(keys):
+            text = ', '.join(keys[:self.MAX_LISTED])
+            if len(keys) > self.MAX_LISTED:
+                text += f", ... ({len(keys) - self.MAX_LISTED} more)"
+            return text
+
+        lines = [f"stations: {len(self.added)} added, {len(self.removed)} removed, {len(self.changed)} changed"]
+        if self.attributes_changed:
+            lines.append("stationlist attributes changed")
+        if self.added:
+            lines.append(f"added: {listed(self.added)}")
+        if self.removed:
+            lines.append(f"removed: {listed(self.removed)}")
+        if self.changed:
+            lines.append(f"changed: {listed(self.changed)}")
+        return '\n'.join(lines)
+
+def _station_changes(key, new, old):
+    """
+    Describe a changed station as 'netid.code' or 'netid.code[comp,...]'.
+    """
+    if not isinstance(new, tuple) or not isinstance(old, tuple) or new[0] != old[0]:
+        return key
+    comps = sorted(name for name in set(new[1]) | set(old[1]) if new[1].get(name) != old[1].get(name))
+    return f"{key}[{','.join(comps)}]"
+
+@timed('diff_stationlists', nbytes=lambda result, source1, *args, **kwargs: data_size(source1))
+def diff_stationlists(source1, source2, ignore_attrs=VOLATILE_XML_ATTRS):
+    """
+    Compare two _dat.xml station lists station by station, in one linear
+    pass over both documents.
+
+    The documents are read side by side: stations found in the same order
+    are compared right away, the others wait in a small table until their
+    counterpart shows up, so memory is bounded by the stations out of order.
+
+    Args:
+        source1 (str or file object): The new station list.
+        source2 (str or file object): The old station list.
+        ignore_attrs (set): Attribute names (without namespace) to ignore.
+
+    Returns:
+        StationListDiff: the stations added, removed and changed in source1 (false if none).
+
+    Raises:
+        xml.etree.ElementTree.ParseError: if a document is not well-formed.
+    """
+    result = StationListDiff()
+    pending_new = {}
+    pending_old = {}
+    items = itertools.zip_longest(iter_stationlist(source1, ignore_attrs), iter_stationlist(source2, ignore_attrs))
+    (_, attrs_new), (_, attrs_old) = next(items)
+    result.attributes_changed = attrs_new != attrs_old
+
+    for item_new, item_old in items:
+        for item, own, other, new_side in ((item_new, pending_new, pending_old, True), (item_old, pending_old, pending_new, False)):
+            if item is None:
+                continue
+            key, value = item
+            if key in other:
+                other_value = other.pop(key)
+                new, old = (value, other_value) if new_side else (other_value, value)
+                if new != old:
+                    result.changed.append(_station_changes(key, new, old))
+            else:
+                own[key] = value
+
+    result.added = list(pending_new)
+    result.removed = list(pending_old)
+    return result
+
+'''
+def diff_old(mode, xmlstring, xml_file):
+    if mode == 'DETAIL_MODE':
+        tree1 = ET.ElementTree(ET.fromstring(xmlstring))
+        root1 = tree1.getroot()
+        event1 = root1.attrib
+
+        tree2 = ET.parse(xml_file)
+        root2 = tree2.getroot()
+        event2 = root2.attrib
+
+        event1.pop('created')
+        event2.pop('created')
+
+        return event1 != event2
+    else:
+        return xmlstring != open(xml_file).read()
+'''
+
+def float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def catalog_to_records(catalog, fdsn_client):
+    """
+    Convert an obspy Catalog to a list of EventRecord, from the first origin
+    and the first magnitude of each event.
+    """
+    records = []
+    for c in catalog:
+        origin = c.origins[0] if c.origins else None
+        magnitude = c.magnitudes[0] if c.magnitudes else None
+        records.append(EventRecord(
+            event_id=extract_id(str(c.resource_id), fdsn_client),
+            time=origin.time.datetime if origin is not None and origin.time is not None else None,
+            latitude=origin.latitude if origin is not None else None,
+            longitude=origin.longitude if origin is not None else None,
+            depth=origin.depth / 1000. if origin is not None and origin.depth is not None else None,
+            magnitude=magnitude.mag if magnitude is not None else None,
+            magnitude_type=magnitude.magnitude_type if magnitude is not None else None
+        ))
+    return records
+
+def parse_fdsn_text(text):
+    """
+    Parse the response of an FDSN event service with format=text, one event per line:
+    EventID|Time|Latitude|Longitude|Depth/km|Author|Catalog|Contributor|ContributorID|MagType|Magnitude|...
 
-    ignored = [
-        d for d in diff_result
-        if isinstance(d, xmldiff_actions.UpdateAttrib) and d.name in ignore_attrs
-    ]
-    meaningful = [d for d in diff_result if d not in ignored]
+    Returns:
+        list of EventRecord. Malformed lines are logged and skipped.
+    """
+    records = []
+    for line in text.splitlines():
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) < 11 or not fields[0]:
+            logger.warning(f"\t\tskipping malformed event line: {line}".expandtabs(TAB_SIZE))
+            continue
+        try:
+            origin_time = parse_time(fields[1])
+        except ValueError:
+            origin_time = None
+        records.append(EventRecord(
+            event_id=fields[0],
+            time=origin_time,
+            latitude=float_or_none(fields[2]),
+            longitude=float_or_none(fields[3]),
+            depth=float_or_none(fields[4]),
+            magnitude=float_or_none(fields[10]),
+            magnitude_type=fields[9] or None
+        ))
+    return records
+
+def text_event_query(fdsn_client):
+    """
+    Return a function querying the FDSN event service of fdsn_client with
+    format=text, through the shared HTTP session, and its URL.
+
+    The function takes the FDSN query parameters (eventid, starttime, ...) and
+    returns a list of EventRecord; it is empty when no event matches (HTTP 204
+    or 404), other errors are raised.
+    """
+    base_url = FDSN_EVENT_URLS[fdsn_client]
+
+    def query(**params):
+        r = http_get(f"{base_url}?{urlencode(dict(params, format='text'))}")
+        if r.status_code in (204, 404):
+            return []
+        r.raise_for_status()
+        return parse_fdsn_text(r.content.decode('utf-8', errors='replace'))
+
+    return query, base_url
+
+def quakeml_event_query(fdsn_client):
+    """
+    Same as text_event_query, through the obspy FDSN client (QuakeML).
+
+    obspy is imported here, so that it is not loaded at all with --event-source text.
+    """
+    from obspy import UTCDateTime
+    from obspy.clients.fdsn.header import URL_MAPPINGS, FDSNNoDataException
+    from obspy.clients.fdsn import Client
+
+    URL_MAPPINGS["EMSC"] = "https://www.seismicportal.eu"
+    client = Client(fdsn_client)
+
+    def query(**params):
+        for key in ('starttime', 'endtime'):
+            if key in params:
+                params[key] = UTCDateTime(params[key])
+        try:
+            return catalog_to_records(client.get_events(**params), fdsn_client)
+        except FDSNNoDataException:
+            return []
+
+    return query, f"{client.base_url}/fdsnws/event/1/query"
+
+def get_sliced_events(get_events, starttime, endtime, lon_ranges, query, workers=1):
+    """
+    Get the events of a time window in slices of at most EVENT_QUERY_SLICE,
+    fetched in parallel. A slice returning EVENT_QUERY_LIMIT events, that is
+    possibly truncated by the service, is split in two halves fetched again.
+
+    Args:
+        get_events: query function returned by text_event_query or quakeml_event_query.
+        starttime, endtime (datetime): the time window.
+        lon_ranges (list): (minlongitude, maxlongitude) pairs, each queried separately.
+        query (dict): the other FDSN query parameters, with limit.
+        workers (int): number of concurrent requests.
+
+    Returns:
+        list of EventRecord, without duplicates (by event ID), ordered as asked by query['orderby'].
+    """
+    def fetch(start, end, lons):
+        return get_events(starttime=start.strftime(TIME_FORMAT), endtime=end.strftime(TIME_FORMAT), minlongitude=lons[0], maxlongitude=lons[1], **query)
+
+    slices = []
+    for lons in lon_ranges:
+        start = starttime
+        while True:
+            end = min(start + EVENT_QUERY_SLICE, endtime)
+            slices.append((start, end, lons))
+            if end >= endtime:
+                break
+            start = end
+
+    events = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(fetch, *s): s for s in slices}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, end, lons = pending.pop(future)
+                metrics.count('event_queries')
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning(f"\t\tevents from {start} to {end} (longitude {lons[0]}/{lons[1]}) not retrieved: {str(e)}".expandtabs(TAB_SIZE))
+                    continue
+                if len(result) >= query['limit']:
+                    if end - start > EVENT_QUERY_MIN_SLICE:
+                        middle = (start + (end - start) / 2).replace(microsecond=0)
+                        logger.info(f"\t\t{len(result)} events from {start} to {end}: splitting at {middle}".expandtabs(TAB_SIZE))
+                        for half in ((start, middle, lons), (middle, end, lons)):
+                            pending[executor.submit(fetch, *half)] = half
+                        continue
+                    logger.warning(f"\t\tevents from {start} to {end} may be truncated at {len(result)}".expandtabs(TAB_SIZE))
+                events += result
+
+    # adjacent slices share their bounds
+    unique = {}
+    for e in events:
+        unique.setdefault(e.event_id, e)
+    events = list(unique.values())
+    if query.get('orderby') in ('time', 'time-asc'):
+        events.sort(key=lambda e: e.time or datetime.min, reverse=query['orderby'] == 'time')
+    return events
+
+def event_dir(event_id):
+    """
+    Directory of the current shake data of an event in the repository.
+    """
+    return os.path.join(args.git_repo_dir, 'data', event_id[:6], event_id, 'current')
+
+def event_exists(event_id):
+    """
+    Tell whether an event is already in the repository, from the event index
+    when it is loaded.
+    """
+    if event_index is not None:
+        return event_index.has_event(event_id)
+    return os.path.isfile(os.path.join(event_dir(event_id), 'event.xml'))
+
+def get_resolved_events():
+    global resolved_events
+    with resolved_events_lock:
+        if resolved_events is None:
+            resolved_events = load_state(RESOLVED_EVENTS_STATE, {})
+    return resolved_events
+
+def save_resolved_events():
+    if resolved_events is not None:
+        # drop the expired entries (and those of the old format, without time)
+        now = time.time()
+        with resolved_events_lock:
+            for key in [k for k, v in resolved_events.items() if not isinstance(v, dict) or now - v['time'] > RESOLVED_EVENTS_TTL * ONEDAY]:
+                del resolved_events[key]
+        save_state(RESOLVED_EVENTS_STATE, resolved_events)
+
+def cache_resolved_event(record):
+    """
+    Save the fields of an event looked up, or seen in a sweep, in the resolved events cache.
+    """
+    fields = [record.time.isoformat() if record.time is not None else None] + list(record[2:])
+    cache = get_resolved_events()
+    with resolved_events_lock:
+        cache[record.event_id] = {'fields': fields, 'time': time.time()}
+
+def refresh_resolved_events(events):
+    """
+    Update the cached events with their records from a sweep, which have the current origin.
+    """
+    cache = get_resolved_events()
+    for record in events:
+        if record.event_id in cache and record.time is not None:
+            cache_resolved_event(record)
+
+def resolve_event_ids(event_ids, event_query, workers=1):
+    """
+    Resolve the -k/--keep event IDs to EventRecord.
 
-    if not meaningful:
-        return False, bool(ignored)
-    return True, False
+    An ID is taken from the resolved events cache when looked up less than
+    RESOLVED_EVENTS_TTL days ago; an event
+    already in the repository is not looked up at all, since only its ID is
+    needed to download its data (its other fields are None); the others are
+    queried concurrently, with workers requests in flight.
 
-'''
-def diff_old(mode, xmlstring, xml_file):
-    if mode == 'DETAIL_MODE':
-        tree1 = ET.ElementTree(ET.fromstring(xmlstring))
-        root1 = tree1.getroot()
-        event1 = root1.attrib
+    Args:
+        event_ids (list): The event IDs.
+        event_query: function returning the (query, URL) pair of the event
+            service, called only when a lookup is needed.
+        workers (int): number of concurrent requests.
 
-        tree2 = ET.parse(xml_file)
-        root2 = tree2.getroot()
-        event2 = root2.attrib
+    Returns:
+        list of EventRecord, in the order of event_ids; the IDs not found are logged and dropped.
+    """
+    cache = get_resolved_events()
+    found = {}
+    to_query = []
+    now = time.time()
+    for event_id in dict.fromkeys(event_ids):
+        cached = cache.get(event_id)
+        if isinstance(cached, dict) and now - cached['time'] <= RESOLVED_EVENTS_TTL * ONEDAY:
+            fields = cached['fields']
+            found[event_id] = [EventRecord(event_id, parse_time(fields[0]) if fields[0] else None, *fields[1:])]
+        elif event_exists(event_id):
+            logger.info(f"\t\tEvent ID {event_id} is already in the repository: lookup skipped".expandtabs(TAB_SIZE))
+            found[event_id] = [EventRecord(event_id, None, None, None, None, None, None)]
+        else:
+            to_query.append(event_id)
 
-        event1.pop('created')
-        event2.pop('created')
+    if to_query:
+        get_events, query_url = event_query()
 
-        return event1 != event2
-    else:
-        return xmlstring != open(xml_file).read()
-'''
+        def lookup(event_id):
+            logger.info(f"\t\tQuerying event ID: {event_id} - URL: {query_url}?eventid={event_id}".expandtabs(TAB_SIZE))
+            return get_events(eventid=event_id)
 
-# routine to extract an obspy catalog and a list of events id from fdsn event ws
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(event_id, executor.submit(lookup, event_id)) for event_id in to_query]
+            for event_id, future in futures:
+                try:
+                    records = future.result()
+                except Exception as e:
+                    logger.warning(f"\t\tFailed to retrieve event {event_id}: {str(e)}".expandtabs(TAB_SIZE))
+                    logger.info(f"\t\t\tAttempted URL: {query_url}?eventid={event_id}".expandtabs(TAB_SIZE))
+                    continue
+                if not records:
+                    logger.warning(f"\t\tEvent {event_id} not found".expandtabs(TAB_SIZE))
+                    continue
+                found[event_id] = records
+                for e in records:
+                    cache_resolved_event(e)
+
+    events = {}
+    for event_id in event_ids:
+        for e in found.get(event_id, []):
+            events.setdefault(e.event_id, e)
+    return list(events.values())
+
+# routine to extract the events (as EventRecord) and a list of events id from fdsn event ws
+@timed('find_events')
 def find_events(
         fdsn_client,
         start_time="1900-01-01",
@@ -522,99 +2188,127 @@ def find_events(
         mode='sing',
         orderby='time',
         verbose=True,
-        event_ids=None
+        event_ids=None,
+        source='quakeml',
+        workers=1
 ):
 
     # mode = hist -> historical records of seismicity (eg. custom time window)
     # mode = sing -> discovery of a (hopefully) single event
+    # source = quakeml -> obspy Client; text -> FDSN format=text, without obspy
+
+    def event_query():
+        if source == 'text':
+            return text_event_query(fdsn_client)
+        return quakeml_event_query(fdsn_client)
 
-    client = Client(fdsn_client)
     # If specific event IDs are provided, query directly by event ID
     if event_ids is not None:
-        logger.info(f"\tGET events by ID: {client.base_url}. PARAMS: fdsn_client={fdsn_client}, event_ids={event_ids}".expandtabs(TAB_SIZE))
-        catalog = Catalog()
-        for event_id in event_ids:
-            try:
-                # Build the URL to show what's being requested
-                # Try different formats for EMSC event IDs
-                query_url = f"{client.base_url}/fdsnws/event/1/query?eventid={event_id}"
-                logger.info(f"\t\tQuerying event ID: {event_id} - URL: {query_url}".expandtabs(TAB_SIZE))
+        logger.info(f"\tGET events by ID: fdsn_client={fdsn_client}, event_ids={event_ids}".expandtabs(TAB_SIZE))
+        events = resolve_event_ids(event_ids, event_query, workers=workers)
 
-                # Try with simple event ID first
-                try:
-                    event_cat = client.get_events(eventid=event_id)
-                except Exception as e1:
-                    # If that fails, try with QuakeML format for EMSC
-                    logger.debug(f"\t\t\tSimple ID failed: {str(e1)}".expandtabs(TAB_SIZE))
-
-                catalog += event_cat
-            except Exception as e:
-                logger.warning(f"\t\tFailed to retrieve event {event_id}: {str(e)}".expandtabs(TAB_SIZE))
-                logger.info(f"\t\t\tAttempted URL: {query_url}".expandtabs(TAB_SIZE))
-
-        if len(catalog) == 0:
+        if len(events) == 0:
             logger.info("No events were found for the provided event IDs")
-            quit()
+            return events, []
     else:
         # Original time-based query logic
-        end_time = UTCDateTime(end_time)
+        get_events, query_url = event_query()
+        end_time = parse_time(end_time)
 
         if mode == 'sing':
-            delta_time = 7 # 7 seconds around event time on either side
+            delta_time = timedelta(seconds=7) # 7 seconds around event time on either side
             starttime = end_time - delta_time
             endtime = end_time + delta_time
         elif mode == 'hist':
             endtime = end_time
-            starttime = UTCDateTime(start_time)
+            starttime = parse_time(start_time)
         else:
             logger.error("mode " + mode + " is not supported.")
-            return False
+            return [], []
 
-        logger.info(f"\tGET: {client.base_url}. PARAMS: fdsn_client={fdsn_client}, start_time={start_time}, end_time={end_time}, minmag={minmag}, maxmag={maxmag}, latmin={latmin}, latmax={latmax}, lonmin={lonmin}, lonmax={lonmax}, mode={mode}, orderby={orderby}".expandtabs(TAB_SIZE))
+        logger.info(f"\tGET: {query_url}. PARAMS: fdsn_client={fdsn_client}, start_time={start_time}, end_time={endtime.strftime(TIME_FORMAT)}, minmag={minmag}, maxmag={maxmag}, latmin={latmin}, latmax={latmax}, lonmin={lonmin}, lonmax={lonmax}, mode={mode}, orderby={orderby}".expandtabs(TAB_SIZE))
 
+        query = dict(minmagnitude=minmag, maxmagnitude=maxmag, minlatitude=latmin, maxlatitude=latmax, orderby=orderby, limit=EVENT_QUERY_LIMIT)
         # another shitty dateline patch
         if lonmax > 180:
             # split in two requests
-            try:
-                cat1 = client.get_events(starttime=starttime, endtime=endtime, minmagnitude=minmag, maxmagnitude=maxmag, minlatitude=latmin, maxlatitude=latmax, minlongitude=lonmin, maxlongitude=180, orderby=orderby, limit=1000)
-            except:
-                cat1 = Catalog()
-
-            try:
-                cat2 = client.get_events(starttime=starttime, endtime=endtime, minmagnitude=minmag, maxmagnitude=maxmag, minlatitude=latmin, maxlatitude=latmax, minlongitude=-180, maxlongitude=-(360-lonmax), orderby=orderby, limit=1000)
-            except:
-                cat2 = Catalog()
-            # combine the catalog object
-            catalog = cat1 + cat2
+            lon_ranges = [(lonmin, 180), (-180, -(360-lonmax))]
         else:
-            try:
-                catalog = client.get_events(starttime=starttime, endtime=endtime, minmagnitude=minmag, maxmagnitude=maxmag, minlatitude=latmin, maxlatitude=latmax, minlongitude=lonmin, maxlongitude=lonmax, orderby=orderby, limit=1000)
-            except:
-                logger.info ("No events were found in the time window: [%s / %s]" % (starttime, endtime))
-                quit()
-
-#     tmp = str(cat[0].resource_id)
-#     event_id = extract_id(tmp, fdsn_client)
-    event_ids_list=[]
-    for c in catalog:
-        tmp = str(c.resource_id)
-        event_ids_list.append(extract_id(tmp, fdsn_client))
+            lon_ranges = [(lonmin, lonmax)]
+        events = get_sliced_events(get_events, starttime, endtime, lon_ranges, query, workers=workers)
+        if not events:
+            logger.info ("No events were found in the time window: [%s / %s]" % (starttime, endtime))
+            return [], []
+
+    event_ids_list = [e.event_id for e in events]
 
     if verbose == True:
 
         logger.info(f'DETAILED LIST OF EVENTS:')
-        for i, c in enumerate(catalog):
-            ot = c.origins[0].time
-            lat = c.origins[0].latitude
-            lon = c.origins[0].longitude
-            dep = c.origins[0].depth #/ 1000.
-            mag = c.magnitudes[0].mag
-            mag_type = c.magnitudes[0].magnitude_type
-            logger.info(f"\t\t{fdsn_client} {event_ids_list[i]}      {ot}   {lat} {lon} {dep}   {mag} ({mag_type})".expandtabs(TAB_SIZE))
+        for e in events:
+            ot = e.time.isoformat() + 'Z' if e.time is not None else None
+            logger.info(f"\t\t{fdsn_client} {e.event_id}      {ot}   {e.latitude} {e.longitude} {e.depth}   {e.magnitude} ({e.magnitude_type})".expandtabs(TAB_SIZE))
     else:
         logger.info(f'\t\tLIST OF EVENTS: {event_ids_list}'.expandtabs(TAB_SIZE))
 
-    return catalog, event_ids_list
+    return events, event_ids_list
+
+def get_esm_updated_after():
+    """
+    Return the updatedafter watermark of the ESM event-processing-update query:
+    --esm-updated-after if given, otherwise the one saved by the last run that
+    processed the updates, otherwise one day ago.
+    """
+    if args.esm_updated_after is not None:
+        return parse_time(args.esm_updated_after).strftime(TIME_FORMAT)
+    state = load_state(ESM_UPDATES_STATE, {})
+    if state.get('updated_after'):
+        return state['updated_after']
+    return (utcnow() - timedelta(days=1)).strftime(TIME_FORMAT)
+
+def save_esm_updated_after(updated_after):
+    """
+    Durably save the watermark of the next ESM event-processing-update query.
+    """
+    save_state(ESM_UPDATES_STATE, {'updated_after': updated_after})
+    # --esm-updated-after only applies until the first successful cycle
+    args.esm_updated_after = None
+    logger.info(f"\tESM updates watermark saved: {updated_after}".expandtabs(TAB_SIZE))
+
+@timed('find_updated_events')
+def find_updated_events():
+    """
+    Query the ESM event-processing-update service for the events whose ESM
+    processing changed after the saved watermark.
+
+    Returns:
+        (event_ids, updated_after): the EMSC event IDs, and the watermark to be
+        saved once they are processed; (None, None) when the request failed,
+        so that the same window is queried again at the next run.
+    """
+    updated_after = get_esm_updated_after()
+    # the next window starts a little before this query, not to lose the updates
+    # published while it runs or hidden by the clock skew with ESM
+    next_updated_after = (utcnow() - timedelta(seconds=ESM_UPDATES_OVERLAP)).strftime(TIME_FORMAT)
+    params = dict(updatedafter=updated_after, minlat=27, maxlat=81, minlon=-32, maxlon=51, minmag=f"{args.minmag:g}")
+    url = f"{ESM_EVENT_UPDATE_URL}?{urlencode(params)}"
+    logger.info(f"\tGET ESM updates: {url}".expandtabs(TAB_SIZE))
+    try:
+        r = http_get(url)
+        if r.status_code == 204:
+            event_ids = []
+        elif r.status_code == 200:
+            event_ids = [e.get('emsc_event_id') for e in r.json()]
+        else:
+            logger.error(f"\t\tESM updates request failed with status code: {r.status_code}".expandtabs(TAB_SIZE))
+            return None, None
+    except Exception as e:
+        logger.error(f"\t\tESM updates request failed: {str(e)}".expandtabs(TAB_SIZE))
+        return None, None
+
+    event_ids = list(dict.fromkeys(eid for eid in event_ids if eid))
+    logger.info(f'\t\tEVENTS UPDATED BY ESM AFTER {updated_after}: {event_ids}'.expandtabs(TAB_SIZE))
+    return event_ids, next_updated_after
 
 def log_summary_data():
     logger.info(f'SUMMARY DATA:')
@@ -623,15 +2317,106 @@ def log_summary_data():
     #logger.info("ESM BCK VERIFICATION (days): %.2f" % (args.chkbcktime))
     #logger.info("\trun at: %s" % (UTCDateTime().strftime("%Y-%m-%dT%H:%M:%S")))
 
+def get_git_repo():
+    global git_repo
+    if git_repo is None:
+        git_repo = git.Repo(args.git_repo_dir+'/.git')
+    return git_repo
+
 @catch_all_and_print
+@timed('git_pull')
 def git_pull():
     logger.info(f"Executing pull from {args.git_repo_dir}")
-    repo = git.Repo(args.git_repo_dir+'/.git')
-    repo.remotes.origin.pull()
+    repo = get_git_repo()
+    if args.sparse_checkout:
+        # only the months of the window are updated in the working tree and,
+        # in a blobless clone, only their files are downloaded
+        months = window_months()
+        set_sparse_checkout(months)
+        repo.git.pull('--ff-only')
+        deepen_history(months)
+    else:
+        repo.remotes.origin.pull()
+
+def window_months():
+    """
+    The data/YYYYMM months of the events of the run: those of the -k event
+    IDs, or those of the time window.
+    """
+    if args.keep is not None:
+        return {eid.strip()[:6] for eid in args.keep.split(',')}
+    return {shard for shard, _, _ in month_shards(args.start_time, args.end_time)}
+
+@timed('sparse_checkout')
+def set_sparse_checkout(months, add=False):
+    """
+    With --sparse-checkout, check out only the data/YYYYMM directories of the
+    given months (besides the files at the top of the repository).
+
+    Args:
+        months (iterable): YYYYMM months.
+        add (bool): add the months to those already checked out, instead of
+            replacing them.
+    """
+    global sparse_checkout_months
+    months = set(months)
+    if add:
+        months -= sparse_checkout_months or set()
+        if not months:
+            return
+    elif months == sparse_checkout_months:
+        return
+    repo = get_git_repo()
+    if sparse_checkout_months is None:
+        repo.git.sparse_checkout('init', '--cone')
+        sparse_checkout_months = set()
+    dirs = [f"data/{month}" for month in sorted(months)]
+    repo.git.sparse_checkout('add' if add else 'set', *dirs)
+    sparse_checkout_months = sparse_checkout_months | months if add else months
+    logger.info(f"Sparse checkout: {'added' if add else 'set to'} {', '.join(dirs)}")
+
+def extend_sparse_checkout(event_ids):
+    """
+    With --sparse-checkout, make sure the months of event_ids are checked
+    out before their files are compared and saved: a file missing from the
+    working tree would be taken for a new one.
+    """
+    if args.sparse_checkout and event_ids:
+        months = {eid[:6] for eid in event_ids}
+        set_sparse_checkout(months, add=True)
+        if deepen_history(months):
+            # the authors of the files of the older months are now known
+            get_repository_files_info(args.git_repo_dir)
+
+def deepen_history(months):
+    """
+    In a shallow clone, fetch the history back to the start of the oldest of
+    the given months: the files of an event are committed after its origin
+    time, so the last author of every file of those months is then known.
+
+    Returns:
+        bool: True if the history was deepened.
+    """
+    boundary = get_git_shallow_commits(args.git_repo_dir)
+    if not boundary or not months:
+        return False
+    # one day of margin for the events near midnight and the clock skew
+    since = datetime.strptime(min(months), '%Y%m').replace(tzinfo=timezone.utc) - timedelta(days=1)
+    dates = subprocess.check_output(["git", "-C", args.git_repo_dir, "show", "-s", "--format=%ct", *sorted(boundary)], stderr=subprocess.DEVNULL).split()
+    if max(int(d) for d in dates) < since.timestamp():
+        return False
+    logger.info(f"Deepening the shallow history since {since.strftime(TIME_FORMAT)}")
+    repo = get_git_repo()
+    repo.git.fetch(f"--shallow-since={since.strftime(TIME_FORMAT)}Z", 'origin')
+    # one commit more, so that the boundary commits, whose changes are not
+    # known, are older than the months checked out
+    repo.git.fetch('--deepen=1', 'origin')
+    return True
 
 @catch_all_and_print
+@timed('git_push')
 def git_push():
-    repo = git.Repo(args.git_repo_dir+'/.git')
+    repo = get_git_repo()
     #repo.git.add('--all')
     # repo.git.add('data')
     # logger.info(f"Executing commit")
@@ -660,23 +2445,229 @@ def git_push():
         origin.push()
 
 @catch_all_and_print
+@timed('git_commit')
 def git_commit(FileFullPath, msg):
-    repo = git.Repo(args.git_repo_dir+'/.git')
+    repo = get_git_repo()
     repo.git.add(FileFullPath)
     #repo.git.add('data')
     #logger.info(f"Executing commit")
-    repo.index.commit(msg)
+    commit = repo.index.commit(msg)
+    set_repository_file_author(FileFullPath, commit.author.name)
+
+def commit_file(FileFullPath, msg, event_id, details=None):
+    """
+    Commit a saved file right away (--commit-mode file) or queue it for
+    flush_commits() (--commit-mode event or run).
+
+    Args:
+        FileFullPath (str): The saved file.
+        msg (str): 'Add event=...' or 'Update event=...'.
+        event_id (str): The event ID.
+        details (str): Optional description of the changes, added to the commit body.
+    """
+    if args.commit_mode == 'file':
+        git_commit(FileFullPath, msg + "\n\n" + details if details else msg)
+    else:
+        pending_commits.append((FileFullPath, msg, event_id, details))
+
+def batch_commit_message(commits):
+    """
+    Build the message of a batched commit: the subject names the event, or
+    counts the events of a larger batch, and the body lists the event IDs and
+    keeps the 'Add event=' / 'Update event=' line of every file.
+    """
+    event_ids = list(dict.fromkeys(event_id for _, _, event_id, _ in commits))
+    if len(event_ids) == 1:
+        if all(msg.startswith('Add ') for _, msg, _, _ in commits):
+            subject = f"Add event={event_ids[0]}"
+        else:
+            subject = f"Update event={event_ids[0]}"
+    else:
+        subject = f"Update {len(event_ids)} events"
+    body = []
+    if len(event_ids) > 1:
+        body.append(f"events={','.join(event_ids)}")
+        body.append("")
+    for FileFullPath, msg, _, details in commits:
+        body.append(f"{msg}: {os.path.relpath(FileFullPath, args.git_repo_dir)}")
+        if details:
+            body.extend(f"    {line}" for line in details.splitlines())
+    return subject + "\n\n" + "\n".join(body)
+
+@catch_all_and_print
+@timed('git_commit')
+def flush_commits():
+    """
+    Stage all the queued files in the index and write them as a single commit.
+    """
+    if not pending_commits:
+        return
+    repo = get_git_repo()
+    index = repo.index
+    index.add([os.path.relpath(FileFullPath, args.git_repo_dir) for FileFullPath, _, _, _ in pending_commits])
+    msg = batch_commit_message(pending_commits)
+    logger.info(f"Executing commit of {len(pending_commits)} file(s): {msg.splitlines()[0]}")
+    commit = index.commit(msg)
+    for FileFullPath, _, _, _ in pending_commits:
+        set_repository_file_author(FileFullPath, commit.author.name)
+    pending_commits.clear()
+
+def generate_events_xml_data(executor=None, workers=None, processes=False):
+    """
+    Download, save and commit every event of args.event_ids.
+
+    Args:
+        executor: pool running fetch_event_xml_data (e.g. the --backfill process
+            pool) with workers workers; by default a pool of --workers threads,
+            or none with --workers 1.
+        processes (bool): executor is a pool of processes (see init_backfill_worker):
+            their cache updates and metrics are merged in this process.
+    """
+    if executor is None and args.workers > 1:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            return generate_events_xml_data(executor, args.workers)
 
-def generate_events_xml_data():
     totalEvents = len(args.event_ids)
+    metrics.count('events', totalEvents)
     spaces = len(str(totalEvents))
-    for index, eid in enumerate(args.event_ids):
-        logger.info(f'{index+1:{spaces}d}/{totalEvents} - DOING EVENT: {eid}')
-        # if eid == '20201030_0000082':
-        generate_event_xml_data(eid)
+    if executor is None:
+        for index, eid in enumerate(args.event_ids):
+            if stop_requested.is_set():
+                logger.warning(f'Stop requested: {totalEvents - index} event(s) left for the next run')
+                return
+            logger.info(f'{index+1:{spaces}d}/{totalEvents} - DOING EVENT: {eid}')
+            # if eid == '20201030_0000082':
+            generate_event_xml_data(eid)
+        return
+
+    # worker-pool mode: downloads run concurrently, while saving and committing
+    # stay in this thread and follow the order of args.event_ids, so the git
+    # history is the same as the one of a serial run
+    logger.info(f'DOWNLOADING {totalEvents} EVENTS WITH {workers} WORKERS')
+    pending = deque()
+    eids = iter(enumerate(args.event_ids))
+    fetch = fetch_backfill_event if processes else fetch_event_xml_data
+    # keep a bounded number of events in flight to limit memory usage
+    for index, eid in itertools.islice(eids, 2 * workers):
+        pending.append((index, eid, executor.submit(fetch, eid)))
+    while pending:
+        if stop_requested.is_set():
+            logger.warning(f'Stop requested: {totalEvents - pending[0][0]} event(s) left for the next run')
+            for _, _, future in pending:
+                future.cancel()
+            return
+        index, eid, future = pending.popleft()
+        fetched = future.result()
+        if processes:
+            fetched = merge_backfill_event(*fetched)
+        for next_index, next_eid in itertools.islice(eids, 1):
+            pending.append((next_index, next_eid, executor.submit(fetch, next_eid)))
+        logger.info(f'{index+1:{spaces}d}/{totalEvents} - SAVING EVENT: {eid}')
+        save_event_xml_data(fetched, eid)
+
+def get_refresh_schedule():
+    global refresh_schedule
+    if refresh_schedule is None:
+        refresh_schedule = load_state(REFRESH_SCHEDULE_STATE, {})
+    return refresh_schedule
+
+def save_refresh_schedule():
+    if refresh_schedule is not None:
+        # drop the events out of every recent window, so that the file does not grow forever
+        now = time.time()
+        for event_id in [k for k, v in refresh_schedule.items() if now - v.get('checked', 0) > REFRESH_SCHEDULE_KEEP * ONEDAY]:
+            del refresh_schedule[event_id]
+        save_state(REFRESH_SCHEDULE_STATE, refresh_schedule)
+
+def refresh_interval(since):
+    """
+    Seconds before the next refresh of an event whose origin, or whose last
+    change, was since seconds ago.
+    """
+    return min(max(since * REFRESH_DECAY, args.refresh_min_interval), args.refresh_max_interval)
+
+def due_events(events, event_ids, always=()):
+    """
+    Select the events due for a refresh, with --adaptive-refresh.
+
+    Args:
+        events (list): EventRecord of the events of the cycle.
+        event_ids (list): The event IDs to be processed, in order.
+        always: IDs processed anyway (e.g. updated by ESM, or asked with -k).
+
+    Returns:
+        list: The event IDs due, in the same order; the events never processed are due.
+    """
+    schedule = get_refresh_schedule()
+    for record in events:
+        if record.time is not None:
+            schedule.setdefault(record.event_id, {})['origin'] = record.time.replace(tzinfo=timezone.utc).timestamp()
+    now = time.time()
+    always = set(always)
+    due = [eid for eid in event_ids if eid in always or schedule.get(eid, {}).get('next_due', 0) <= now]
+    metrics.count('events_not_due', len(event_ids) - len(due))
+    logger.info(f'EVENTS DUE FOR REFRESH: {len(due)} of {len(event_ids)}')
+    return due
+
+def schedule_refresh(event_id, changed):
+    """
+    Set the next refresh of an event just processed, with --adaptive-refresh:
+    the polling is dense after the origin time and decays with its age, and
+    a change of its data restarts it as if the event were new.
+    """
+    if not args.adaptive_refresh:
+        return
+    now = time.time()
+    entry = get_refresh_schedule().setdefault(event_id, {})
+    if changed:
+        entry['changed'] = now
+    since = now - max(entry.get('origin') or 0, entry.get('changed') or 0)
+    interval = refresh_interval(since)
+    entry['checked'] = now
+    entry['next_due'] = now + interval
+    logger.info(f"\tnext refresh in {interval / 60:.0f} min".expandtabs(TAB_SIZE))
 
 def generate_event_xml_data(event_id):
-    EVENT_DIR = os.path.join(args.git_repo_dir, 'data', event_id[:6], event_id, 'current')
+    save_event_xml_data(fetch_event_xml_data(event_id), event_id)
+
+@timed('save_event', nbytes=lambda result, fetched, event_id: fetched_size(fetched))
+def save_event_xml_data(fetched, event_id):
+    """
+    Save (and commit) the files downloaded by fetch_event_xml_data().
+
+    Args:
+        fetched (list): (data, FileFullPath, manifest entry, fingerprint) tuples, in commit order.
+        event_id (str): The event ID.
+    """
+    changed = False
+    for data, FileFullPath, entry, fingerprint in fetched:
+        if data is not None:
+            changed = saveIfChanged(data, FileFullPath, event_id, fingerprint) or changed
+        if entry is not None and os.path.isfile(FileFullPath):
+            # the content saved from this download, whether it changed or not
+            set_manifest_entry(FileFullPath, dict(entry, output_sha256=file_sha256(FileFullPath)))
+    if args.commit_mode == 'event':
+        flush_commits()
+    schedule_refresh(event_id, changed)
+
+@timed('fetch_event', nbytes=lambda fetched, event_id: fetched_size(fetched))
+def fetch_event_xml_data(event_id):
+    """
+    Download all the shake data of an event without touching the repository.
+
+    Args:
+        event_id (str): The event ID.
+
+    Returns:
+        list: (data, FileFullPath, manifest entry, fingerprint) tuples, in
+        commit order; data is None when the file is unchanged since the last
+        download, fingerprint is the XmlFingerprint of data when it is saved
+        as downloaded (None otherwise).
+    """
+    if args.workers > 1:
+        logger.info(f'DOWNLOADING EVENT: {event_id}')
+    EVENT_DIR = event_dir(event_id)
+    fetched = []
 
     # Track if any data was successfully downloaded
     any_data_downloaded = False
@@ -691,9 +2682,10 @@ def generate_event_xml_data(event_id):
     if result:
         url_ESM_dat = "https://esm-db.eu/esmws/shakemap/1/query?flag=all&apb=true&apg=true&eventid=%s&catalog=%s&format=event_dat" % (str(event_id), fdsn_client)
         logger.info(f"\trequest \"_dat.xml\" on: {url_ESM_dat}".expandtabs(TAB_SIZE))
-        data = DownloadData(url_ESM_dat)
-        if data:
-            saveIfChanged(data, FILE_FULL_NAME_DAT, event_id)
+        download = DownloadUnlessNoData(event_id, 'esm_dat', url_ESM_dat, FILE_FULL_NAME_DAT)
+        if download.entry:
+            fetched.append((download.data, FILE_FULL_NAME_DAT, download.entry, download.fingerprint))
+        if download.status in (200, 304):
             any_data_downloaded = True
     else:
         logger.warning(f"\tfile {FILE_NAME_DAT} skipped because modified by the external user: {author}".expandtabs(TAB_SIZE))
@@ -702,33 +2694,38 @@ def generate_event_xml_data(event_id):
     # EVENT DATA
     # ===================================
     data_event = None
+    FNAME_EV = os.path.join(EVENT_DIR, "event.xml")
+    # the saved event.xml also depends on the -u and -r options
+    variant_event = f"update_eventid={args.update_eventid},update_locstring={args.update_locstring}"
     # DOWNLOAD ESM EVENT
     url_ESM_event = "https://esm-db.eu/esmws/shakemap/1/query?eventid=%s&catalog=%s&format=event" % (str(event_id), fdsn_client)
     logger.info(f"\trequest \"event.xml\" on: {url_ESM_event}".expandtabs(TAB_SIZE))
-    data = DownloadData(url_ESM_event)
-    if data:
-        data_event = clean_event_data(data)
-        any_data_downloaded = True
-    else:
+    download = DownloadUnlessNoData(event_id, 'esm_event', url_ESM_event, FNAME_EV, variant_event)
+    if download.status not in (200, 304):
         # DOWNLOAD RRSM EVENT
         url_RRSM_event = "http://www.orfeus-eu.org/odcws/rrsm/1/shakemap?eventid=%s&type=event" % (str(event_id))
         logger.info(f"\trequest \"event.xml\" on: {url_RRSM_event}".expandtabs(TAB_SIZE))
-        data = DownloadData(url_RRSM_event)
-        if data:
-            data_event = clean_event_data(data)
-            any_data_downloaded = True
+        download = DownloadUnlessNoData(event_id, 'rrsm_event', url_RRSM_event, FNAME_EV, variant_event)
+    if download.status in (200, 304):
+        any_data_downloaded = True
+    if download.data:
+        data_event = clean_event_data(download.data)
 
     if data_event:
         # Apply optional updates (-u and/or -r) to the event XML before saving
-        data_event = update_event_xml(data_event, event_id)
-        FNAME_EV = os.path.join(EVENT_DIR, "event.xml")
+        failures = []
+        data_event = update_event_xml(data_event, event_id, failures)
         relative_path = os.path.relpath(FNAME_EV, args.git_repo_dir)
         result, author = check_repository_file(relative_path)
 
         if result:
-            saveIfChanged(data_event, FNAME_EV, event_id)
+            # an event.xml not fully updated is saved, but not recorded in the
+            # manifest: it is downloaded and updated again at the next run
+            fetched.append((data_event, FNAME_EV, None if failures else download.entry, None))
         else:
             logger.warning(f"event.xml skipped because modified by the external user: {author}".expandtabs(TAB_SIZE))
+    elif download.entry:
+        fetched.append((None, FNAME_EV, download.entry, None))
 
     # ===================================
 
@@ -742,9 +2739,10 @@ def generate_event_xml_data(event_id):
     if result:
         url_RRSM_dat = "http://www.orfeus-eu.org/odcws/rrsm/1/shakemap?eventid=%s" % (str(event_id))
         logger.info(f"\trequest \"_dat.xml\" on: {url_RRSM_dat}".expandtabs(TAB_SIZE))
-        data = DownloadData(url_RRSM_dat)
-        if data:
-            saveIfChanged(data, FILE_FULL_NAME_DAT, event_id)
+        download = DownloadUnlessNoData(event_id, 'rrsm_dat', url_RRSM_dat, FILE_FULL_NAME_DAT)
+        if download.entry:
+            fetched.append((download.data, FILE_FULL_NAME_DAT, download.entry, download.fingerprint))
+        if download.status in (200, 304):
             any_data_downloaded = True
     else:
         logger.warning(f"file {FILE_NAME_DAT} skipped because modified by the external user: {author}".expandtabs(TAB_SIZE))
@@ -763,9 +2761,11 @@ def generate_event_xml_data(event_id):
         if result:
             url_REPORTED_INTENSITY = f"https://seismicportal.eu/testimonies-ws/api/shakemap?unid={event_id}&gridsize=1&format=xml"
             logger.info(f"\trequest \"_REPORTED-INTENSITY_dat.xml.test\" on: {url_REPORTED_INTENSITY}".expandtabs(TAB_SIZE))
-            data = DownloadDataWithAuth(url_REPORTED_INTENSITY, args.get_reported_intensity_token)
-            if data:
-                saveIfChanged(data, FILE_FULL_NAME_REPORTED_INTENSITY, event_id)
+            headers = {'Authorization': f'Bearer {args.get_reported_intensity_token}'}
+            download = DownloadUnlessNoData(event_id, 'reported_intensity', url_REPORTED_INTENSITY, FILE_FULL_NAME_REPORTED_INTENSITY, headers=headers)
+            if download.entry:
+                fetched.append((download.data, FILE_FULL_NAME_REPORTED_INTENSITY, download.entry, download.fingerprint))
+            if download.status in (200, 304):
                 any_data_downloaded = True
         else:
             logger.warning(f"\tfile {FILE_NAME_REPORTED_INTENSITY} skipped because modified by the external user: {author}".expandtabs(TAB_SIZE))
@@ -775,21 +2775,26 @@ def generate_event_xml_data(event_id):
     if any_data_downloaded:
         url_str_fault = "https://esm-db.eu/esmws/shakemap/1/query?eventid=%s&catalog=%s&format=event_fault" % (str(event_id), fdsn_client)
         logger.info(f"\trequest \"_fault.xml\" on: {url_str_fault}".expandtabs(TAB_SIZE))
-        data = DownloadData(url_str_fault)
-        if data:
-            jdict = text_to_json(data, new_format=False)
-            FNAME_RUPT = os.path.join(EVENT_DIR, "rupture.json")
+        FNAME_RUPT = os.path.join(EVENT_DIR, "rupture.json")
+        download = DownloadUnlessNoData(event_id, 'esm_fault', url_str_fault, FNAME_RUPT)
+        if download.data:
+            jdict = text_to_json(download.data, new_format=False)
             relative_path = os.path.relpath(FNAME_RUPT, args.git_repo_dir)
             result, author = check_repository_file(relative_path)
 
             if result:
                 # Convert JSON to bytes and use saveIfChanged to handle git commit
-                saveIfChanged(json.dumps(jdict).encode(), FNAME_RUPT, event_id)
+                fetched.append((json.dumps(jdict).encode(), FNAME_RUPT, download.entry, None))
             else:
                 logger.warning(f"\trupture.json skipped because modified by the external user: {author}".expandtabs(TAB_SIZE))
+        elif download.entry:
+            fetched.append((None, FNAME_RUPT, download.entry, None))
     else:
         logger.info(f"\tSkipping fault data request - no event data was successfully downloaded".expandtabs(TAB_SIZE))
 
+    return fetched
+
+@timed('text_to_json', nbytes=lambda result, data, *args, **kwargs: data_size(data))
 def text_to_json(data, new_format=True):
     """
     Read in old or new ShakeMap 3 textfile rupture format and convert to
@@ -918,36 +2923,66 @@ def text_to_json(data, new_format=True):
 
     return json_dict
 
-def saveIfChanged(data, FileFullPath, event_id):
+def saveIfChanged(data, FileFullPath, event_id, fingerprint=None):
+    metrics.count('saved_bytes', len(data))
+    details = None
     if os.path.isfile(FileFullPath):
+        # the XmlFingerprint of a download is compared with the saved file's,
+        # so that the downloaded XML is not parsed again (None if unknown)
+        xml_changed = None
+        if fingerprint is not None:
+            try:
+                xml_changed = xml_file_fingerprint(FileFullPath, xml_ignored_attrs(FileFullPath)) != fingerprint
+            except ET.ParseError:
+                pass
+        if xml_changed is False:
+            logger.info(f"\t\tskipping commit: same XML content as {os.path.basename(FileFullPath)}".expandtabs(TAB_SIZE))
+            return
         # Check if file is JSON - use simple byte comparison instead of XML diff
         if FileFullPath.endswith('.json'):
             # For JSON files, compare content directly
             with open(FileFullPath, 'rb') as f:
                 existing_data = f.read()
             has_changed = (data != existing_data)
+        elif FileFullPath.endswith('_dat.xml'):
+            # For station lists, compare station by station and keep the report for the commit message
+            try:
+                report = diff_stationlists(io.BytesIO(data), FileFullPath)
+                has_changed = bool(report)
+                if has_changed:
+                    details = f"{os.path.basename(FileFullPath)}: {report.summary()}"
+            except ET.ParseError:
+                has_changed = diff(data, FileFullPath)
         elif '_REPORTED-INTENSITY_dat.xml.test' in FileFullPath:
             # For reported intensity files, ignore changes to the 'downloaded' attribute
             # which is regenerated on every request and carries no meaningful information
-            has_changed, only_downloaded = diff_ignoring_attrs(data, FileFullPath, {'downloaded'})
+            has_changed, only_downloaded = (True, False) if xml_changed else diff_ignoring_attrs(data, FileFullPath, {'downloaded'})
             if only_downloaded:
                 logger.info(f"\t\tskipping commit: only 'downloaded' attribute changed in reported intensity file".expandtabs(TAB_SIZE))
                 return
         else:
-            # For XML files, use xmldiff
-            has_changed = diff(data, FileFullPath)
+            # For XML files, compare the content ignoring the volatile attributes
+            has_changed = xml_changed or diff(data, FileFullPath)
 
         if has_changed:
             with open (FileFullPath, mode='wb') as f:
                 f.write(data)
+            index_event_file(FileFullPath, data)
             msg = f"Update event={event_id}"
             logger.info(f"\t\tcommit: {msg}".expandtabs(TAB_SIZE))
-            git_commit(FileFullPath, msg)
+            if details:
+                logger.info(f"\t\t{details}".replace('\n', '; ').expandtabs(TAB_SIZE))
+            metrics.count('files_updated')
+            commit_file(FileFullPath, msg, event_id, details)
+            return True
     else:
         writeFile(data, FileFullPath)
+        index_event_file(FileFullPath, data)
         msg = f"Add event={event_id}"
         logger.info(f"\t\tcommit: {msg}".expandtabs(TAB_SIZE))
-        git_commit(FileFullPath, msg)
+        metrics.count('files_added')
+        commit_file(FileFullPath, msg, event_id)
+        return True
 
 
 def writeFile(data, FileFullPath):
@@ -957,9 +2992,206 @@ def writeFile(data, FileFullPath):
     with open(FileFullPath, mode='wb') as f:
         f.write(data)
 
-# set the dictionary of the repository files with the author and date of last modification
+def load_state(name, default):
+    """
+    Load a JSON state file from args.state_dir.
+
+    Returns:
+        The decoded content, or default if the file is missing or unreadable.
+    """
+    path = os.path.join(args.state_dir, name)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        logger.warning(f"state file {path} ignored: {str(e)}")
+        return default
+
+def save_state(name, obj):
+    """
+    Atomically write a JSON state file into args.state_dir.
+    """
+    os.makedirs(args.state_dir, exist_ok=True)
+    path = os.path.join(args.state_dir, name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+def get_git_log_authors(repo_path, revision_range=None):
+    """
+    Walk the git history once and return, for each path, the author of the
+    most recent commit touching it, as git log -1 -- <path> would.
+
+    A merge commit lists (-c) the paths that differ from all of its parents:
+    those merged with changes on both sides are attributed to the merge, the
+    others to the commit of the side that changed them.
+
+    Args:
+        repo_path (str): The repository directory.
+        revision_range (str): Optional range (e.g. 'old..new'); default is the whole HEAD history.
+
+    Returns:
+        dict: path -> author.
+    """
+    cmd = ["git", "-C", repo_path, "-c", "core.quotepath=off", "log", "-c", "--no-renames", "--name-only", "--format=%x00%H%x00%an"]
+    if revision_range:
+        cmd.append(revision_range)
+    output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+    boundary = get_git_shallow_commits(repo_path)
+    authors = {}
+    author = None
+    for line in output.decode('utf-8', errors='replace').splitlines():
+        if line.startswith('\x00'):
+            commit, author = line[1:].split('\x00', 1)
+            if commit in boundary:
+                author = None
+        elif line and author is not None:
+            # history is newest first: keep the first author seen for each path
+            authors.setdefault(line, author)
+    return authors
+
+@functools.lru_cache(maxsize=None)
+def git_path(repo_path, name):
+    """
+    Path of a file of the .git directory of repo_path.
+    """
+    path = subprocess.check_output(["git", "-C", repo_path, "rev-parse", "--git-path", name], stderr=subprocess.DEVNULL).decode().strip()
+    return os.path.join(repo_path, path)
+
+def get_git_shallow_commits(repo_path):
+    """
+    The commits at the boundary of a shallow clone. Their parents are
+    missing, so they seem to add every file they contain: they are not
+    attributed as the last change of those files.
+    """
+    path = git_path(repo_path, "shallow")
+    if not os.path.isfile(path):
+        return set()
+    with open(path) as f:
+        return set(f.read().split())
+
+def git_is_ancestor(repo_path, ancestor, commit):
+    return subprocess.call(
+        ["git", "-C", repo_path, "merge-base", "--is-ancestor", ancestor, commit],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    ) == 0
+
+# set the dictionary of the repository files with the author of last modification
+@timed('last_author_index')
 def get_repository_files_info(path):
-    return {}
+    """
+    Load the path -> last author index of the repository.
+
+    The index is saved in args.state_dir together with the HEAD it refers to,
+    and it is updated incrementally from the commits added since then; it is
+    rebuilt with a full history pass only when that HEAD is no longer an
+    ancestor of the current one.
+    """
+    global repository_files
+    try:
+        head = subprocess.check_output(["git", "-C", path, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+        boundary = sorted(get_git_shallow_commits(path))
+        state = load_state(REPOSITORY_FILES_STATE, {})
+        indexed_head = state.get('head')
+        authors = state.get('authors', {})
+
+        if state.get('shallow', []) != boundary:
+            # a deepened (or new) shallow clone: the files behind the old
+            # boundary may now have an author
+            authors = get_git_log_authors(path)
+            indexed_head = None
+            logger.info(f"Last-author index built: {len(authors)} files")
+        elif indexed_head == head:
+            logger.info(f"Last-author index is up to date ({len(authors)} files)")
+        elif indexed_head and git_is_ancestor(path, indexed_head, head):
+            changes = get_git_log_authors(path, f"{indexed_head}..{head}")
+            authors.update(changes)
+            logger.info(f"Last-author index updated: {len(changes)} file(s) changed since {indexed_head[:8]}")
+        else:
+            authors = get_git_log_authors(path)
+            logger.info(f"Last-author index built: {len(authors)} files")
+    except subprocess.CalledProcessError as e:
+        # check_repository_file falls back to 'git log' for each file
+        logger.warning(f"Last-author index not available: {str(e)}")
+        repository_files = None
+        return {}
+
+    if indexed_head != head:
+        save_state(REPOSITORY_FILES_STATE, {'head': head, 'shallow': boundary, 'authors': authors})
+    repository_files = authors
+    return repository_files
+
+@timed('event_index')
+def sync_event_index():
+    """
+    Open the event index in args.state_dir and sync it with the repository
+    HEAD; the first time, every file in data/ is indexed.
+
+    Errors are logged: the run goes on without the index.
+    """
+    global event_index
+    try:
+        if event_index is None:
+            event_index = EventIndex(os.path.join(args.state_dir, EVENT_INDEX_STATE))
+        changed = event_index.sync(args.git_repo_dir)
+        if changed is None:
+            logger.info(f"Event index built")
+        elif changed:
+            logger.info(f"Event index updated: {changed} file(s) changed")
+    except Exception as e:
+        logger.warning(f"Event index not available: {str(e)}")
+        event_index = None
+
+@timed('station_store')
+def sync_station_store():
+    """
+    With --station-store, open the station store in args.state_dir and sync
+    it with the repository HEAD; the first time, every _dat.xml file is stored.
+
+    Errors are logged: the run goes on without the store.
+    """
+    global station_store
+    if not args.station_store:
+        return
+    try:
+        if station_store is None:
+            # numpy is only needed with --station-store
+            from station_store import StationStore
+            try:
+                station_store = StationStore(os.path.join(args.state_dir, STATION_STORE_STATE))
+            except ValueError as e:
+                logger.warning(f"Station store damaged, rebuilding it: {str(e)}")
+                station_store = StationStore(os.path.join(args.state_dir, STATION_STORE_STATE), reset=True)
+        changed = station_store.sync(args.git_repo_dir)
+        if changed is None:
+            logger.info(f"Station store built: {station_store.catalog['rows']} rows")
+        elif changed:
+            logger.info(f"Station store updated: {changed} file(s) changed")
+    except Exception as e:
+        logger.warning(f"Station store not available: {str(e)}")
+        station_store = None
+
+def index_event_file(FileFullPath, data):
+    """
+    Update the event index, and the station store, with a file just saved.
+    """
+    if event_index is not None:
+        event_index.update_file(args.git_repo_dir, FileFullPath, data)
+    if station_store is not None:
+        try:
+            station_store.update_file(args.git_repo_dir, FileFullPath, data)
+        except ET.ParseError as e:
+            logger.warning(f"\t\t{os.path.basename(FileFullPath)} not added to the station store: {str(e)}".expandtabs(TAB_SIZE))
+
+def set_repository_file_author(FileFullPath, author):
+    """
+    Keep the last-author index in line with the commits made by this run.
+    """
+    if repository_files is not None:
+        repository_files[os.path.relpath(FileFullPath, args.git_repo_dir)] = author
 
 
 def get_git_last_author(repo_path, file_path):
@@ -968,11 +3200,14 @@ def get_git_last_author(repo_path, file_path):
     """
     try:
         output = subprocess.check_output(
-            ["git", "-C", repo_path, "log", "-1", "--pretty=format:%an", file_path],
+            ["git", "-C", repo_path, "log", "-1", "--pretty=format:%H%x00%an", file_path],
             stderr=subprocess.DEVNULL
         )
-        author = output.decode().strip()
-        return author if author else None
+        commit, _, author = output.decode().strip().partition('\x00')
+        # in a shallow clone, the boundary commit is not the last change of the file
+        if not author or commit in get_git_shallow_commits(repo_path):
+            return None
+        return author
 
     except subprocess.CalledProcessError:
         # File not tracked by Git or no commits touching it
@@ -983,7 +3218,8 @@ def check_repository_file(file_name):
     """
     Returns (True, None) if the file can be safely created or overwritten.
     Returns (True, username) if the last author is the same as GIT_USERNAME.
-    Returns (False, 'other-author') if the file was last modified by someone else.
+    Returns (False, 'other-author') if the file was last modified by someone else,
+    or by an unknown author in a shallow clone.
     """
 
     repo_path = args.git_repo_dir
@@ -995,8 +3231,15 @@ def check_repository_file(file_name):
     if not os.path.exists(file_path):
         return True, None
 
-    # Ask Git for the last author
-    author = get_git_last_author(repo_path, file_name)
+    # Ask the last-author index, or Git when the index is not loaded
+    if repository_files is not None:
+        author = repository_files.get(os.path.normpath(file_name))
+    else:
+        author = get_git_last_author(repo_path, file_name)
+
+    # In a shallow clone, an unknown author may be anybody before the boundary → block overwrite
+    if author is None and get_git_shallow_commits(repo_path):
+        return False, 'unknown (last changed before the shallow clone boundary)'
 
     # If Git does not know the file → safe
     if author is None:
@@ -1010,10 +3253,370 @@ def check_repository_file(file_name):
     return False, author
 
 
+def check_data_file(FileFullPath):
+    """
+    Check a file stored in data/: XML well-formedness, the required
+    attributes of event.xml, the station lists not being empty and the
+    rupture GeoJSON (validate_json).
+
+    Returns:
+        (sha256, problems): the hash of the content and the list of the problems found.
+    """
+    with open(FileFullPath, 'rb') as f:
+        data = f.read()
+    sha256 = hashlib.sha256(data).hexdigest()
+    name = os.path.basename(FileFullPath)
+    problems = []
+    if name.endswith('.xml') or name.endswith('.xml.test'):
+        try:
+            root = parse_xml(data)
+        except ET.ParseError as e:
+            return sha256, [f"XML not well-formed: {str(e)}"]
+        if name == 'event.xml':
+            if _local_name(root.tag) != 'earthquake':
+                problems.append(f"root element is <{_local_name(root.tag)}>, not <earthquake>")
+            missing = [attr for attr in REQUIRED_EVENT_ATTRS if attr not in root.attrib]
+            if missing:
+                problems.append(f"missing attributes: {', '.join(missing)}")
+            for attr in ('lat', 'lon', 'depth', 'mag'):
+                if attr in root.attrib and float_or_none(root.attrib[attr]) is None:
+                    problems.append(f"attribute {attr} is not a number: {root.attrib[attr]!r}")
+            try:
+                if 'time' in root.attrib:
+                    parse_time(root.attrib['time'])
+            except ValueError:
+                problems.append(f"attribute time is not valid: {root.attrib['time']!r}")
+        elif name.endswith('_dat.xml') or name.endswith('_dat.xml.test'):
+            if _local_name(root.tag) != 'stationlist':
+                problems.append(f"root element is <{_local_name(root.tag)}>, not <stationlist>")
+            elif not any(_local_name(e.tag) == 'station' for e in root.iter()):
+                problems.append("empty station list")
+    elif name.endswith('.json'):
+        try:
+            validate_json(json.loads(data))
+        except Exception as e:
+            problems.append(f"rupture GeoJSON not valid: {e.__class__.__name__}: {str(e)}")
+    return sha256, problems
+
+@timed('scan_integrity')
+def scan_integrity():
+    """
+    Check every file in data/ with check_data_file, in --scan-processes
+    processes, and write a JSON report to --scan-report.
+
+    The hash and the problems of each file are kept in args.state_dir: a
+    file whose content did not change since the last scan is not checked
+    again, so a rescan only reads and hashes the files.
+    """
+    data_dir = os.path.join(args.git_repo_dir, 'data')
+    paths = sorted(
+        os.path.relpath(os.path.join(dirpath, name), args.git_repo_dir)
+        for dirpath, _, names in os.walk(data_dir) for name in names
+    )
+    previous = load_state(INTEGRITY_SCAN_STATE, {})
+
+    def file_hash(relative_path):
+        return file_sha256(os.path.join(args.git_repo_dir, relative_path))
+
+    # hashing is I/O bound: threads are enough
+    with ThreadPoolExecutor(max_workers=args.scan_processes) as executor:
+        hashes = dict(zip(paths, executor.map(file_hash, paths)))
+    results = {path: previous[path] for path in paths if path in previous and previous[path]['sha256'] == hashes[path]}
+    to_check = [path for path in paths if path not in results]
+    logger.info(f"INTEGRITY SCAN: {len(paths)} files, {len(to_check)} to check with {args.scan_processes} processes")
+
+    with ProcessPoolExecutor(max_workers=args.scan_processes) as executor:
+        full_paths = [os.path.join(args.git_repo_dir, path) for path in to_check]
+        for path, (sha256, problems) in zip(to_check, executor.map(check_data_file, full_paths, chunksize=64)):
+            results[path] = {'sha256': sha256, 'problems': problems}
+    save_state(INTEGRITY_SCAN_STATE, results)
+
+    problems = {path: results[path]['problems'] for path in paths if results[path]['problems']}
+    report = {
+        'date': utcnow().strftime(TIME_FORMAT) + 'Z',
+        'repository': os.path.abspath(args.git_repo_dir),
+        'files': len(paths),
+        'checked': len(to_check),
+        'unchanged': len(paths) - len(to_check),
+        'files_with_problems': len(problems),
+        'problems': problems,
+    }
+    report_path = args.scan_report or os.path.join(args.state_dir, INTEGRITY_REPORT)
+    write_text_atomically(report_path, json.dumps(report, indent=2) + '\n')
+    for path, file_problems in problems.items():
+        logger.warning(f"\t{path}: {'; '.join(file_problems)}".expandtabs(TAB_SIZE))
+    logger.info(f"INTEGRITY SCAN: {len(problems)} file(s) with problems, report written to {report_path}")
+    return report
+
+def run():
+    if args.build_flinn_engdahl_grid:
+        get_flinn_engdahl_grid(rebuild=True)
+        return
+
+    if args.scan_integrity:
+        scan_integrity()
+        return
+
+    if args.relabel_locstrings:
+        git_pull()
+        get_repository_files_info(args.git_repo_dir)
+        sync_event_index()
+        sync_station_store()
+        try:
+            relabel_locstrings()
+        finally:
+            flush_commits()
+        git_push()
+        return
+
+    if args.backfill:
+        run_backfill()
+    elif args.daemon:
+        run_daemon()
+    else:
+        run_cycle()
+
+def install_stop_handlers():
+    """
+    Make SIGTERM and SIGINT set stop_requested, so that the run stops after
+    the current event, committing and pushing what was done.
+    """
+    def request_stop(signum, frame):
+        logger.info(f"Received signal {signum}: stopping after the current event")
+        stop_requested.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+def run_daemon():
+    """
+    Run a cycle every --poll-interval seconds until SIGTERM or SIGINT.
+
+    HTTP connection pools, caches, indexes and the repository handle stay
+    loaded between cycles; a stop signal lets the current event finish,
+    commits and pushes what was done, then exits.
+    """
+    global metrics
+
+    install_stop_handlers()
+    logger.info(f"Starting daemon mode, polling every {args.poll_interval:.0f}s")
+
+    while not stop_requested.is_set():
+        cycle_start = time.time()
+        metrics = RunMetrics()
+        set_time_window()
+        try:
+            run_cycle()
+        except SystemExit:
+            # catch_all_and_print already logged the error: retry at the next cycle
+            logger.error("Cycle aborted")
+        except Exception as e:
+            logger.critical(f"Cycle aborted by an unexpected error: {str(e)}")
+        write_metrics()
+        stop_requested.wait(max(0., args.poll_interval - (time.time() - cycle_start)))
+    logger.info("Daemon stopped")
+
+def month_shards(start_time, end_time):
+    """
+    Split a time window into calendar months, the shards of --backfill.
+
+    Returns:
+        list of (shard, start, end): shard is YYYYMM, like the data/YYYYMM
+        directories; start and end are datetimes clamped to the window.
+    """
+    start = parse_time(start_time)
+    end = parse_time(end_time)
+    shards = []
+    while True:
+        first_day = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        next_month = (first_day + timedelta(days=32)).replace(day=1)
+        shard_end = min(next_month, end)
+        shards.append((first_day.strftime('%Y%m'), start, shard_end))
+        if shard_end >= end:
+            return shards
+        start = shard_end
+
+def init_backfill_worker(parent_args):
+    """
+    Initialize a --backfill worker process, which only runs fetch_event_xml_data:
+    saving and committing stay in the parent process.
+    """
+    global args, logger, http_session, host_policies, git_repo
+    args = parent_args
+    if logger is None:
+        logger = create_logger(args.log_severity)
+    # connections, host policies and repository handles inherited by fork are not shared
+    http_session = None
+    host_policies = {}
+    git_repo = None
+    # the parent process handles the stop signals
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    get_repository_files_info(args.git_repo_dir)
+
+def fetch_backfill_event(event_id):
+    """
+    Run fetch_event_xml_data in a --backfill worker process.
+
+    Returns:
+        (fetched, journal, metrics): the files of the event, the locstring and
+        negative cache entries changed while fetching them, and the metrics
+        of the fetch, to be merged in the parent (see merge_backfill_event).
+    """
+    global metrics, cache_journal
+    metrics = RunMetrics()
+    cache_journal = {'locstring': {}, 'negative': {}}
+    fetched = fetch_event_xml_data(event_id)
+    return fetched, cache_journal, metrics.summary()
+
+def merge_backfill_event(fetched, journal, summary):
+    """
+    Merge in this process the cache updates and metrics of fetch_backfill_event;
+    the caches are saved with the run state.
+    """
+    if journal['locstring']:
+        cache = get_locstring_cache()
+        with locstring_cache_lock:
+            cache.update(journal['locstring'])
+    if journal['negative']:
+        cache = get_negative_cache()
+        with negative_cache_lock:
+            for event_id, entry in journal['negative'].items():
+                if entry is None:
+                    cache.pop(event_id, None)
+                else:
+                    cache[event_id] = entry
+    metrics.merge(summary)
+    return fetched
+
+def run_backfill():
+    """
+    Process the -s/-e (or -d) window one month at a time.
+
+    Downloads run in a pool of --backfill-processes processes, while this
+    process saves and commits, in order, as in worker-pool mode. Every shard
+    is committed and checkpointed in --state-dir when done, so a new run with
+    the same window skips the months already processed.
+    """
+    install_stop_handlers()
+    checkpoints = load_state(BACKFILL_STATE, {})
+    # shards done with a different minimum magnitude are not reused
+    done = checkpoints.setdefault(f"minmag={args.minmag:g}", {})
+    shards = month_shards(args.start_time, args.end_time)
+    logger.info(f"BACKFILL: {len(shards)} month(s) from {args.start_time} to {args.end_time} with {args.backfill_processes} processes")
+
+    git_pull()
+    get_repository_files_info(args.git_repo_dir)
+    sync_event_index()
+    sync_station_store()
+    try:
+        with ProcessPoolExecutor(max_workers=args.backfill_processes, initializer=init_backfill_worker, initargs=(args,)) as executor:
+            for shard, start, end in shards:
+                if stop_requested.is_set():
+                    break
+                start_time = start.strftime(TIME_FORMAT)
+                end_time = end.strftime(TIME_FORMAT)
+                checkpoint = done.get(shard)
+                if checkpoint is not None and checkpoint[0] <= start_time and checkpoint[1] >= end_time:
+                    logger.info(f"SHARD {shard}: already done, skipped")
+                    continue
+                logger.info(f"SHARD {shard}: {start_time} - {end_time}")
+                args.events, args.event_ids = find_events(
+                    fdsn_client,
+                    start_time=start_time,
+                    end_time=end_time,
+                    minmag=args.minmag,
+                    latmin=27,
+                    latmax=81,
+                    lonmin=-32,
+                    lonmax=51,
+                    mode='hist',
+                    verbose=args.verbose,
+                    source=args.event_source,
+                    workers=args.query_workers
+                )
+                if args.event_ids:
+                    extend_sparse_checkout(args.event_ids)
+                    generate_events_xml_data(executor, args.backfill_processes, processes=True)
+                flush_commits()
+                save_run_state()
+                if stop_requested.is_set():
+                    break
+                done[shard] = [start_time, end_time]
+                save_state(BACKFILL_STATE, checkpoints)
+    finally:
+        # never leave saved files uncommitted, even when the run is aborted
+        flush_commits()
+        save_run_state()
+    git_push()
+
+def run_cycle():
+    git_pull()
+    get_repository_files_info(args.git_repo_dir)
+    sync_event_index()
+    sync_station_store()
+
+    log_summary_data()
+    # my strategy is to have only one variabe shared by all functins, that is args
+
+    # Parse event IDs from --keep option if provided
+    keep_ids = None
+    if args.keep is not None:
+        keep_ids = [eid.strip() for eid in args.keep.split(',')]
+        logger.info(f'QUERYING SPECIFIC EVENTS: {keep_ids}')
+
+    # events whose ESM processing changed since the last run (--esm-updates)
+    updated_ids, updated_after = None, None
+    if args.esm_updates is not None:
+        updated_ids, updated_after = find_updated_events()
+
+    if args.esm_updates == 'only':
+        args.events, args.event_ids = [], []
+    else:
+        args.events, args.event_ids = find_events(
+            fdsn_client,
+            start_time=args.start_time,
+            end_time=args.end_time,
+            minmag=args.minmag,
+            latmin=27,
+            latmax=81,
+            lonmin=-32,
+            lonmax=51,
+            mode='hist',
+            verbose=args.verbose,
+            event_ids=keep_ids,
+            source=args.event_source,
+            workers=args.query_workers
+        )
+    if keep_ids is None:
+        refresh_resolved_events(args.events)
+    invalidate_negative_cache(args.events, updated_ids)
+    if updated_ids:
+        # the updated events go first, so they are refreshed even if the sweep is long
+        args.event_ids = list(dict.fromkeys(updated_ids + args.event_ids))
+    if args.adaptive_refresh:
+        args.event_ids = due_events(args.events, args.event_ids, (updated_ids or []) + (keep_ids or []))
+    if not args.event_ids:
+        if updated_after is not None:
+            save_esm_updated_after(updated_after)
+        return
+
+    extend_sparse_checkout(args.event_ids)
+    try:
+        generate_events_xml_data()
+    finally:
+        # never leave saved files uncommitted, even when the run is aborted
+        flush_commits()
+        save_run_state()
+    # move the watermark only when every updated event was processed
+    if updated_after is not None and not stop_requested.is_set():
+        save_esm_updated_after(updated_after)
+    git_push()
+
+
 if __name__ == '__main__':
 
     # define the default value of end_time to 'now'
-    default_end_time = UTCDateTime().strftime("%Y-%m-%dT%H:%M:%S")
+    default_end_time = utcnow().strftime(TIME_FORMAT)
     #
     # default min magnitude
     default_minmag = 4.0
@@ -1024,16 +3627,55 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-o", "--output", dest="git_repo_dir", required=True, help="provide the shakemap installation home dir (e.g., /Users/michelini/shakemap_profiles/world)")
+    parser.add_argument("--state-dir", default=None, help="directory of the persistent indexes and caches [default is <output>/.git/shakedata]")
     parser.add_argument("-d", "--days_ago", default=None, help="set the number of days before end time (15m, 1d, 5d, 10d, 30d, 365d); [default is 1d: today 00:00 to 23:59]; cannot be used with -k/--keep", choices=['15m', '1d', '5d', '10d', '30d', '365d'])
     parser.add_argument("-s", "--starttime", default=None, help="provide the start time (e.g., 2020-10-23T00:00:00); cannot be used with -d/--days_ago or -k/--keep")
     parser.add_argument("-e", "--endtime", default=None, help="provide the end time (e.g., 2020-10-23T23:59:59); [default is now]; cannot be used with -d/--days_ago or -k/--keep")
     parser.add_argument("-m", "--minmag", nargs="?", default=None, help="provide the minimum magnitude (e.g.,4.5); [default is 4.0]; cannot be used with -k/--keep")
     #parser.add_argument("-b","--chkbcktime", nargs="?", default=default_chkbcktime, help="provide the number of days to check for ESM new input data [default is 1.0]")
     parser.add_argument("-k", "--keep", nargs="?", default=None, help="comma-separated list of event IDs to process (e.g., 20251120_0000107,20251118_0000302); cannot be used with time parameters (-d, -s, -e) or -m/--minmag; if not provided, all events in time range will be processed")
+    parser.add_argument("--event-source", default='quakeml', choices=['quakeml', 'text'], help="'quakeml' gets the events through the obspy FDSN client; 'text' queries the FDSN event service with format=text and parses only the fields used, without loading obspy [default is quakeml]")
+    parser.add_argument("--esm-updates", default=None, choices=['with-sweep', 'only'], help="also process ('with-sweep') or only process ('only') the events whose ESM processing was updated since the last run, from the ESM event-processing-update service; the watermark is kept in --state-dir; cannot be used with -k/--keep")
+    parser.add_argument("--esm-updated-after", default=None, help="with --esm-updates, get the ESM updates after this time (e.g., 2025-05-06T00:00:00) instead of the saved watermark [default is the last run, or 1 day ago]")
+    parser.add_argument("--query-workers", type=int, default=4, help="number of concurrent requests to the FDSN event service; long time windows are queried in slices of 30 days, split again when a slice reaches the 1000 events limit [default is 4]")
     parser.add_argument("-u", "--update-eventid", action='store_true', default=False, help="if set, updates the 'id' attribute in event.xml to match the event ID used in the query")
     parser.add_argument("-r", "--update-locstring", default=None, choices=['region_name', 'boundary'], help="updates the 'locstring' attribute in event.xml: 'region_name' uses INGV region_name API, 'boundary' uses INGV Flinn-Engdahl boundary API")
+    parser.add_argument("--locstring-engine", default='remote', choices=['remote', 'offline'], help="with -r boundary, 'offline' looks the Flinn-Engdahl region up in a local grid instead of calling the INGV boundary API; the grid is built (once) in --state-dir [default is remote]")
+    parser.add_argument("--relabel-locstrings", action='store_true', default=False, help="set the locstring of every event.xml in the repository from the offline Flinn-Engdahl grid, commit and exit")
+    parser.add_argument("--build-flinn-engdahl-grid", action='store_true', default=False, help="(re)build the offline Flinn-Engdahl grid in --state-dir and exit")
+    parser.add_argument("--locstring-cache-ttl", type=float, default=30.0, help="days a location string (or a \"no result\" answer) is kept in the on-disk cache; 0 disables the cache [default is 30]")
+    parser.add_argument("--locstring-cache-precision", type=int, default=3, help="number of decimals the coordinates are rounded to, for the location string cache [default is 3]")
+    parser.add_argument("--adaptive-refresh", action='store_true', default=False, help="process only the events due for a refresh: an event is refreshed again after 1/10 of the time since its origin, or since its data last changed, between --refresh-min-interval and --refresh-max-interval; the events updated by ESM or given with -k are always processed")
+    parser.add_argument("--refresh-min-interval", type=float, default=300.0, help="minimum seconds between two refreshes of an event with --adaptive-refresh [default is 300]")
+    parser.add_argument("--refresh-max-interval", type=float, default=21600.0, help="maximum seconds between two refreshes of an event with --adaptive-refresh [default is 21600]")
+    parser.add_argument("--negative-cache-ttl", type=float, default=15.0, help="minutes an upstream source that has no data for an event (HTTP 204/404) is not asked again for it; the time doubles at each consecutive \"no data\" answer, and is reset when ESM updates the event or its catalog origin changes; 0 disables the cache [default is 15]")
+    parser.add_argument("--negative-cache-max-ttl", type=float, default=1440.0, help="maximum minutes of --negative-cache-ttl after many \"no data\" answers [default is 1440]")
     parser.add_argument("--get-reported-intensity", action='store_true', default=False, help="if set, downloads reported intensity data from SeismicPortal testimonies-ws; requires --get-reported-intensity-token")
     parser.add_argument("--get-reported-intensity-token", default=None, help="Bearer token for SeismicPortal testimonies-ws API; required when --get-reported-intensity is used")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of events downloaded concurrently; files are still saved and committed one event at a time, in the same order of a serial run [default is 1]")
+    parser.add_argument("--commit-mode", default='file', choices=['file', 'event', 'run'], help="'file' makes one commit per changed file, 'event' one commit per event, 'run' one commit per run [default is file]")
+    parser.add_argument("--force-download", action='store_true', default=False, help="ignore the download manifest: download, compare and save every file, even if unchanged upstream")
+    parser.add_argument("--max-download-size", type=float, default=100.0, help="maximum size in MB of a downloaded file; larger downloads are dropped [default is 100]")
+    parser.add_argument("--connect-timeout", type=float, default=10.0, help="HTTP connect timeout in seconds [default is 10]")
+    parser.add_argument("--read-timeout", type=float, default=60.0, help="HTTP read timeout in seconds [default is 60]")
+    parser.add_argument("--http-retries", type=int, default=3, help="number of retries on connection errors and HTTP 5xx responses [default is 3]")
+    parser.add_argument("--http-backoff", type=float, default=1.0, help="backoff factor in seconds of the jittered exponential backoff between HTTP retries [default is 1.0]")
+    parser.add_argument("--host-rate", type=float, default=10.0, help="maximum requests per second to each upstream host; 0 disables the limit [default is 10]")
+    parser.add_argument("--host-max-in-flight", type=int, default=4, help="maximum concurrent requests to each upstream host [default is 4]")
+    parser.add_argument("--breaker-failures", type=int, default=5, help="consecutive failed requests (connection errors, timeouts, HTTP 5xx) after which a host is skipped for --breaker-cooldown seconds [default is 5]")
+    parser.add_argument("--breaker-cooldown", type=float, default=300.0, help="seconds the requests to a failing host fail at once, before a new attempt [default is 300]")
+    parser.add_argument("--sparse-checkout", action='store_true', default=False, help="worker mode for a shallow, sparse clone (e.g. git clone --depth 1 --filter=blob:none --sparse): only the data/YYYYMM directories of the events of the run are checked out and updated; cannot be used with --relabel-locstrings or --scan-integrity")
+    parser.add_argument("--backfill", action='store_true', default=False, help="process the -s/-e (or -d) window one month at a time, downloading in --backfill-processes processes; each month is committed and checkpointed in --state-dir, so an interrupted backfill resumes from the first month not done")
+    parser.add_argument("--backfill-processes", type=int, default=None, help="number of processes downloading events with --backfill [default is the number of CPUs]")
+    parser.add_argument("--station-store", action='store_true', default=False, help="keep the columnar store of the station amplitudes (station_store.py, requires numpy) up to date in --state-dir")
+    parser.add_argument("--scan-integrity", action='store_true', default=False, help="check every file in data/ (XML well-formedness, event.xml attributes, empty station lists, rupture GeoJSON), write a JSON report and exit; files unchanged since the last scan are not checked again")
+    parser.add_argument("--scan-report", default=None, help="JSON report of --scan-integrity [default is <state-dir>/integrity_report.json]")
+    parser.add_argument("--scan-processes", type=int, default=None, help="number of processes checking files with --scan-integrity [default is the number of CPUs]")
+    parser.add_argument("--daemon", action='store_true', default=False, help="keep running and process the -d/--days_ago window every --poll-interval seconds, until SIGTERM/SIGINT; cannot be used with -k, -s or -e")
+    parser.add_argument("--poll-interval", type=float, default=300.0, help="seconds between the start of two cycles in --daemon mode [default is 300]")
+    parser.add_argument("--metrics-json", default=None, help="file the per-stage and per-host metrics of the run are written to, as JSON")
+    parser.add_argument("--metrics-prom", default=None, help="file the per-stage and per-host metrics of the run are written to, in the Prometheus textfile-collector format (e.g. /var/lib/node_exporter/textfile/shakedata.prom)")
+    parser.add_argument("--profile", default=None, help="profile the run with cProfile and dump the statistics to this file (and a text report to <file>.txt)")
     parser.add_argument("-v", "--verbose", action='store_true')
     parser.add_argument("-l", "--log_severity",
                         type=str,
@@ -1045,31 +3687,14 @@ if __name__ == '__main__':
     set_args()
     logger = create_logger(args.log_severity)
     
-    git_pull()
-    get_repository_files_info(args.git_repo_dir)
-
-    log_summary_data()
-    # my strategy is to have only one variabe shared by all functins, that is args
-
-    # Parse event IDs from --keep option if provided
-    keep_ids = None
-    if args.keep is not None:
-        keep_ids = [eid.strip() for eid in args.keep.split(',')]
-        logger.info(f'QUERYING SPECIFIC EVENTS: {keep_ids}')
-
-    args.catalog, args.event_ids = find_events(
-        fdsn_client,
-        start_time=args.start_time,
-        end_time=args.end_time,
-        minmag=args.minmag,
-        latmin=27,
-        latmax=81,
-        lonmin=-32,
-        lonmax=51,
-        mode='hist',
-        verbose=args.verbose,
-        event_ids=keep_ids
-    )
-
-    generate_events_xml_data()
-    git_push()
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            write_profile(profiler)
+        write_metrics()
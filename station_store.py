@@ -0,0 +1,446 @@
+"""
+Columnar store of the station amplitudes of the _dat.xml files in the data/
+directory of a shakemap-input-eu repository, for cross-event studies that
+would otherwise parse thousands of XML files.
+
+Each column (event, station, component, source, coordinates, one column per
+IMT and one flag column per IMT) is a raw NumPy array in its own .bin file,
+with one row per station component; columns are read as memory-mapped arrays.
+Rows are only appended: when a file changes, its new rows are appended and the
+old ones are dropped from catalog.json, which maps each file to its range of
+rows, and are removed by the next compaction. Compactions and rebuilds write
+a new generation of the columns, which replaces the previous one when the
+catalog pointing to it is written: a crash leaves the previous generation in use.
+
+shakedata.py --station-store keeps it up to date while saving files; it can be
+rebuilt and queried from the command line:
+
+    $ python station_store.py -o /opt/shakemap-input-eu --imt psa10 --source esm --unflagged
+
+or from Python:
+
+    store = StationStore(default_store_path(repo_dir))
+    rows = store.select(imt='psa10', sources=['esm'], bbox=(36, 47, 6, 19))
+    table = store.table(rows, ['event', 'station', 'latitude', 'longitude', 'psa10'])
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from event_index import split_data_path, file_source, git_output, default_state_dir
+
+# intensity measure types of the components; intensity is an attribute of the
+# station, in the macroseismic files
+IMTS = ('acc', 'vel', 'psa03', 'psa10', 'psa30')
+STATION_IMTS = ('intensity',)
+
+COLUMNS = dict(
+    [
+        ('event', np.int32),
+        ('station', np.int32),
+        ('component', np.int32),
+        ('source', np.int8),
+        ('latitude', np.float64),
+        ('longitude', np.float64),
+        ('depth', np.float32),
+    ]
+    + [(imt, np.float64) for imt in IMTS + STATION_IMTS]
+    # 0 for a good value, 1 for a flagged one, -1 when the value is missing
+    + [(f'flag_{imt}', np.int8) for imt in IMTS]
+)
+# the columns holding an index into the catalog names
+CODED_COLUMNS = {'event': 'events', 'station': 'stations', 'component': 'components', 'source': 'sources'}
+
+CATALOG = 'catalog.json'
+# compact the columns when less than this fraction of the rows is still in use
+COMPACT_RATIO = 0.5
+
+def empty_catalog(generation=0):
+    return {'rows': 0, 'files': {}, 'events': [], 'stations': [], 'components': [], 'sources': [], 'generation': generation}
+
+def default_store_path(repo_dir, state_dir=None):
+    """
+    Path of the store in the shakedata.py state directory of repo_dir.
+    """
+    return os.path.join(state_dir or default_state_dir(repo_dir), 'station_store')
+
+def is_station_file(name):
+    return name.endswith('_dat.xml')
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def parse_stationlist(data):
+    """
+    Read the station components of a _dat.xml file.
+
+    Returns:
+        list of dict, one per component (one per station without components,
+        with component ''), with station, component, latitude, longitude,
+        depth, the IMT values and their flags.
+    """
+    root = ET.fromstring(data, parser=ET.XMLParser(encoding='utf-8'))
+    rows = []
+    for station in root.iter():
+        if local_name(station.tag) != 'station':
+            continue
+        common = {
+            'station': f"{station.get('netid', '')}.{station.get('code', '')}",
+            'latitude': to_float(station.get('lat')),
+            'longitude': to_float(station.get('lon')),
+        }
+        for imt in STATION_IMTS:
+            common[imt] = to_float(station.get(imt))
+        comps = [comp for comp in station if local_name(comp.tag) == 'comp']
+        if not comps:
+            rows.append(dict(common, component='', depth=np.nan))
+        for comp in comps:
+            row = dict(common, component=comp.get('name', ''), depth=to_float(comp.get('depth')))
+            for value in comp:
+                imt = local_name(value.tag)
+                if imt in IMTS:
+                    row[imt] = to_float(value.get('value'))
+                    row[f'flag_{imt}'] = 0 if value.get('flag', '0').strip() in ('', '0') else 1
+            rows.append(row)
+    return rows
+
+class StationStore:
+    """
+    Append-only columnar store, in the directory path.
+
+    Changes are made durable by commit(), which writes the catalog; rows
+    appended after the last commit are discarded when the store is opened.
+
+    Raises ValueError when a column is missing or shorter than the catalog;
+    reset=True then opens the store empty, to be rebuilt (see sync).
+    """
+
+    def __init__(self, path, reset=False):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        try:
+            with open(os.path.join(path, CATALOG)) as f:
+                self.catalog = json.load(f)
+        except FileNotFoundError:
+            self.catalog = empty_catalog()
+        if reset:
+            # a new generation: the damaged columns are removed by the next commit
+            self.catalog = empty_catalog(self.catalog.get('generation', 0) + 1)
+        self.codes = {name: {value: code for code, value in enumerate(self.catalog[name])} for name in CODED_COLUMNS.values()}
+        self.cache = None
+        self.dirty = False
+        for column, dtype in COLUMNS.items():
+            column_path = self.column_path(column)
+            size = self.catalog['rows'] * np.dtype(dtype).itemsize
+            if not os.path.exists(column_path):
+                if self.catalog['rows']:
+                    raise ValueError(f"station store {path}: missing column {column}")
+                open(column_path, 'wb').close()
+            elif os.path.getsize(column_path) < size:
+                raise ValueError(f"station store {path}: column {column} is shorter than the catalog")
+            elif os.path.getsize(column_path) > size:
+                # drop the rows appended after the last commit
+                with open(column_path, 'r+b') as f:
+                    f.truncate(size)
+        if not reset:
+            self.remove_stale_columns()
+
+    def column_path(self, column, generation=None):
+        if generation is None:
+            generation = self.catalog.get('generation', 0)
+        return os.path.join(self.path, f'{column}.bin' if generation == 0 else f'{column}.{generation}.bin')
+
+    def remove_stale_columns(self):
+        """
+        Remove the column files of the other generations, left by a compaction
+        or a rebuild, committed or not.
+        """
+        current = {os.path.basename(self.column_path(column)) for column in COLUMNS}
+        for name in os.listdir(self.path):
+            if name.endswith('.bin') and name not in current:
+                os.remove(os.path.join(self.path, name))
+
+    def code(self, name, value):
+        codes = self.codes[name]
+        if value not in codes:
+            codes[value] = len(self.catalog[name])
+            self.catalog[name].append(value)
+        return codes[value]
+
+    def columns(self):
+        """
+        Return the columns, as read-only memory-mapped arrays (rows no longer
+        in use included, see live).
+        """
+        if self.cache is None:
+            rows = self.catalog['rows']
+            self.cache = {
+                column: np.memmap(self.column_path(column), dtype=dtype, mode='r', shape=(rows,)) if rows else np.empty(0, dtype=dtype)
+                for column, dtype in COLUMNS.items()
+            }
+        return self.cache
+
+    def live(self):
+        """
+        Boolean mask of the rows of the current version of each file.
+        """
+        mask = np.zeros(self.catalog['rows'], dtype=bool)
+        for start, stop in self.catalog['files'].values():
+            mask[start:stop] = True
+        return mask
+
+    def update_file(self, repo_dir, path, data=None):
+        """
+        Store the stations of a _dat.xml file of the repository, replacing the
+        previous version, or remove them if the file no longer exists; other
+        files are ignored.
+
+        Args:
+            repo_dir (str): The repository directory.
+            path (str): Path of the file, absolute or relative to repo_dir.
+            data (bytes): Content of the file, if already in memory.
+        """
+        relative_path = os.path.relpath(os.path.join(repo_dir, path), repo_dir)
+        split = split_data_path(relative_path)
+        if split is None or not is_station_file(split[1]):
+            return
+        if data is None:
+            try:
+                with open(os.path.join(repo_dir, relative_path), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                self.remove_file(relative_path)
+                return
+        event_id, name = split
+        rows = parse_stationlist(data)
+
+        values = {column: [] for column in COLUMNS}
+        event = self.code('events', event_id)
+        source = self.code('sources', file_source(name))
+        for row in rows:
+            values['event'].append(event)
+            values['source'].append(source)
+            values['station'].append(self.code('stations', row['station']))
+            values['component'].append(self.code('components', row['component']))
+            for column in COLUMNS:
+                if column in CODED_COLUMNS:
+                    continue
+                values[column].append(row.get(column, -1 if column.startswith('flag_') else np.nan))
+
+        start = self.catalog['rows']
+        for column, dtype in COLUMNS.items():
+            with open(self.column_path(column), 'ab') as f:
+                np.asarray(values[column], dtype=dtype).tofile(f)
+        self.catalog['rows'] = start + len(rows)
+        self.catalog['files'][relative_path] = [start, start + len(rows)]
+        self.cache = None
+        self.dirty = True
+
+    def update_file_or_skip(self, repo_dir, path):
+        """
+        Same as update_file, for the bulk updates: a malformed file is left out of the store.
+        """
+        try:
+            self.update_file(repo_dir, path)
+        except ET.ParseError:
+            self.remove_file(path)
+
+    def remove_file(self, relative_path):
+        if self.catalog['files'].pop(os.path.normpath(relative_path), None) is not None:
+            self.dirty = True
+
+    def compact(self):
+        """
+        Write a new generation of the columns with only the rows in use; it
+        replaces the current one when the catalog is committed.
+        """
+        columns = self.columns()
+        new_files = {}
+        order = [np.empty(0, dtype=np.int64)]
+        offset = 0
+        for relative_path, (start, stop) in sorted(self.catalog['files'].items(), key=lambda item: item[1][0]):
+            new_files[relative_path] = [offset, offset + stop - start]
+            order.append(np.arange(start, stop))
+            offset += stop - start
+        order = np.concatenate(order)
+        generation = self.catalog.get('generation', 0) + 1
+        for column in COLUMNS:
+            np.asarray(columns[column][order]).tofile(self.column_path(column, generation))
+        self.cache = None
+        self.catalog['generation'] = generation
+        self.catalog['rows'] = offset
+        self.catalog['files'] = new_files
+        self.dirty = True
+
+    def commit(self):
+        """
+        Make the changes durable, compacting the columns when most rows are no longer in use.
+        """
+        if not self.dirty:
+            return
+        rows = self.catalog['rows']
+        if rows and sum(stop - start for start, stop in self.catalog['files'].values()) < COMPACT_RATIO * rows:
+            self.compact()
+        path = os.path.join(self.path, CATALOG)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.catalog, f)
+        os.replace(tmp_path, path)
+        self.dirty = False
+        self.remove_stale_columns()
+
+    def rebuild(self, repo_dir):
+        """
+        Store again every _dat.xml file in the data/ directory of repo_dir, in
+        a new generation of the columns that replaces the current one when the
+        catalog is committed.
+        """
+        self.catalog = empty_catalog(self.catalog.get('generation', 0) + 1)
+        self.codes = {name: {} for name in CODED_COLUMNS.values()}
+        for column in COLUMNS:
+            open(self.column_path(column), 'wb').close()
+        self.cache = None
+        data_dir = os.path.join(repo_dir, 'data')
+        for month in sorted(os.listdir(data_dir)) if os.path.isdir(data_dir) else []:
+            month_dir = os.path.join(data_dir, month)
+            if not os.path.isdir(month_dir):
+                continue
+            for event_id in sorted(os.listdir(month_dir)):
+                current_dir = os.path.join(month_dir, event_id, 'current')
+                if not os.path.isdir(current_dir):
+                    continue
+                for name in sorted(os.listdir(current_dir)):
+                    if is_station_file(name):
+                        self.update_file_or_skip(repo_dir, os.path.join('data', month, event_id, 'current', name))
+        self.dirty = True
+
+    def sync(self, repo_dir):
+        """
+        Bring the store up to date with the HEAD of repo_dir, like EventIndex.sync.
+
+        Returns:
+            int: number of files stored again, or None when the store was rebuilt.
+        """
+        head = git_output(repo_dir, "rev-parse", "HEAD").strip()
+        indexed_head = self.catalog.get('head')
+        if indexed_head == head:
+            return 0
+        changed = None
+        if indexed_head is not None:
+            try:
+                git_output(repo_dir, "merge-base", "--is-ancestor", indexed_head, head)
+                changed = git_output(repo_dir, "diff", "--no-renames", "--name-only", indexed_head, head, "--", "data").splitlines()
+            except subprocess.CalledProcessError:
+                changed = None
+        if changed is None:
+            self.rebuild(repo_dir)
+        else:
+            changed = [path for path in changed if is_station_file(path)]
+            for path in changed:
+                self.update_file_or_skip(repo_dir, path)
+        self.catalog['head'] = head
+        self.dirty = True
+        self.commit()
+        return None if changed is None else len(changed)
+
+    def select(self, event_ids=None, stations=None, sources=None, bbox=None, imt=None, unflagged=False):
+        """
+        Find the rows in use matching all the given filters.
+
+        Args:
+            event_ids (list): event IDs.
+            stations (list): station keys (netid.code).
+            sources (list): sources of the files (e.g. 'esm', 'rrsm').
+            bbox (tuple): (minlat, maxlat, minlon, maxlon), included.
+            imt (str): only the rows with a value of this IMT.
+            unflagged (bool): with imt, only the values not flagged.
+
+        Returns:
+            numpy array of row indexes, for table().
+        """
+        columns = self.columns()
+        mask = self.live()
+        for column, values in (('event', event_ids), ('station', stations), ('source', sources)):
+            if values is not None:
+                codes = self.codes[CODED_COLUMNS[column]]
+                mask &= np.isin(columns[column], [codes[v] for v in values if v in codes])
+        if bbox is not None:
+            minlat, maxlat, minlon, maxlon = bbox
+            mask &= (columns['latitude'] >= minlat) & (columns['latitude'] <= maxlat)
+            mask &= (columns['longitude'] >= minlon) & (columns['longitude'] <= maxlon)
+        if imt is not None:
+            mask &= ~np.isnan(columns[imt])
+            if unflagged and imt in IMTS:
+                mask &= columns[f'flag_{imt}'] == 0
+        return np.nonzero(mask)[0]
+
+    def table(self, rows, columns=None):
+        """
+        Read the given rows.
+
+        Args:
+            rows (numpy array): row indexes, e.g. from select().
+            columns (list): the columns to read [default is all].
+
+        Returns:
+            dict: column -> numpy array; event, station, component and source
+            are decoded to their names.
+        """
+        data = self.columns()
+        table = {}
+        for column in columns or COLUMNS:
+            values = np.asarray(data[column][rows])
+            if column in CODED_COLUMNS:
+                names = np.array(self.catalog[CODED_COLUMNS[column]] or [''], dtype=object)
+                values = names[values]
+            table[column] = values
+        return table
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Query the columnar store of the station amplitudes of a shakemap-input-eu repository.")
+    parser.add_argument("-o", "--output", dest="git_repo_dir", required=True, help="provide the repository directory (e.g., /opt/shakemap-input-eu)")
+    parser.add_argument("--state-dir", default=None, help="state directory of shakedata.py, as given to its --state-dir [default is <output>/.git/shakedata]")
+    parser.add_argument("--store", default=None, help="directory of the store [default is <state-dir>/station_store]")
+    parser.add_argument("--rebuild", action='store_true', default=False, help="store again every _dat.xml file in data/")
+    parser.add_argument("--no-sync", action='store_true', default=False, help="query the store as it is, without syncing it with the git HEAD first")
+    parser.add_argument("-k", "--keep", default=None, help="comma-separated list of event IDs")
+    parser.add_argument("--station", action='append', default=None, help="station key (netid.code); can be repeated")
+    parser.add_argument("--source", action='append', default=None, help="source of the files (e.g., esm, rrsm); can be repeated")
+    parser.add_argument("--bbox", nargs=4, type=float, default=None, metavar=('MINLAT', 'MAXLAT', 'MINLON', 'MAXLON'))
+    parser.add_argument("--imt", default=None, choices=IMTS + STATION_IMTS, help="only the rows with a value of this IMT")
+    parser.add_argument("--unflagged", action='store_true', default=False, help="with --imt, only the values not flagged")
+    args = parser.parse_args()
+
+    try:
+        store = StationStore(args.store or default_store_path(args.git_repo_dir, args.state_dir), reset=args.rebuild)
+        if args.rebuild:
+            store.rebuild(args.git_repo_dir)
+            store.catalog['head'] = git_output(args.git_repo_dir, "rev-parse", "HEAD").strip()
+            store.commit()
+        elif not args.no_sync:
+            store.sync(args.git_repo_dir)
+    except (OSError, ValueError, ET.ParseError, subprocess.CalledProcessError) as e:
+        sys.exit(f"station store: {str(e)}")
+
+    rows = store.select(
+        event_ids=[eid.strip() for eid in args.keep.split(',')] if args.keep else None,
+        stations=args.station, sources=args.source, bbox=args.bbox, imt=args.imt, unflagged=args.unflagged
+    )
+    columns = ['event', 'source', 'station', 'component', 'latitude', 'longitude'] + ([args.imt] if args.imt else list(IMTS + STATION_IMTS))
+    table = store.table(rows, columns)
+    print(','.join(columns))
+    for i in range(len(rows)):
+        print(','.join(str(table[column][i]) for column in columns))